@@ -1,8 +1,9 @@
 from components.core.application import Application, create_application, show, register_error
 from components.core.crontab import Crontab
 from components.core.messages import MessageDocument, MessageGenerator
+from components.core.segments import SegmentedMessageDocument
 from components.core.rows import RowDocument
-from components.core.metadata import Metadata
+from components.core.metadata import Metadata, MetadataError
 from components.core.catalog import Catalog, CatalogException
 from components.core.filesystem import FileSystem
 from components.core.store import Store
@@ -13,3 +14,6 @@ from components.core.text_lines import TextLines
 from components.core.text_lines_with_keys import TextLinesWithKeys
 from components.core.webclient import open_webclient, WebClient
 from components.core.scraper import open_scraper, Scraper
+from components.core.httpcache import DiskCache
+from components.core.throttle import Throttle, RetryPolicy
+from components.core.async_scraper import open_async_scraper, AsyncScraper, scrape
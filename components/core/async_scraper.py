@@ -0,0 +1,224 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import logging
+from typing import (
+    Any,
+    AsyncGenerator,
+    Deque,
+    Dict,
+    Generator,
+    Iterable,
+    Optional,
+    Set,
+    Tuple,
+)
+from urllib.parse import urlsplit
+
+# optional, needed only for the async scraper
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from components.helpers import classname, get_timestamp
+
+
+class AsyncScraperError(Exception):
+    pass
+
+
+# requests in flight, and to the same host
+CONCURRENCY = 1 << 10
+PER_HOST = 8
+
+# urls read ahead by get_many, waiting for a slot of their host
+BACKLOG = 1 << 16
+
+
+def get_host(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+class AsyncScraper:
+    """Scraper.get for many urls at once, on an asyncio event loop.
+    At most concurrency requests are in flight, at most per_host of
+    them to the same host. get_many() yields results as they complete,
+    each (content, attributes) as Scraper.get returns them; the
+    attributes of a failed request also hold its "original url".
+    """
+
+    def __init__(
+        self,
+        concurrency: int = CONCURRENCY,
+        per_host: int = PER_HOST,
+        timeout: float = 60.0,
+    ) -> None:
+        if aiohttp is None:
+            raise AsyncScraperError(f"{classname(self):s}: aiohttp is not installed")
+        self._concurrency: int = concurrency
+        self._per_host: int = per_host
+        self._timeout: float = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._hosts: Dict[str, asyncio.Semaphore] = {}
+
+    @property
+    def concurrency(self) -> int:
+        return self._concurrency
+
+    @property
+    def per_host(self) -> int:
+        return self._per_host
+
+    async def start(self) -> None:
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"User-Agent": "Mozilla/5.0"},
+            timeout=aiohttp.ClientTimeout(total=self._timeout),
+        )
+        self._slots = asyncio.Semaphore(self.concurrency)
+        logging.info(f"{classname(self):s}.start()")
+
+    async def stop(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        logging.info(f"{classname(self):s}.stop()")
+
+    def host_slots(self, url: str) -> asyncio.Semaphore:
+        host = get_host(url)
+        try:
+            return self._hosts[host]
+        except KeyError:
+            self._hosts[host] = asyncio.Semaphore(self.per_host)
+            return self._hosts[host]
+
+    async def get(self, url: str) -> Tuple[str, Dict[Any, Any]]:
+        # the host slot first, so a request waiting for a busy host
+        # doesn't hold one of the global slots
+        async with self.host_slots(url), self._slots:
+            try:
+                async with self._session.get(url) as response:
+                    content = await response.text(errors="replace")
+                    http_code = response.status
+                    attributes = {
+                        "timestamp": get_timestamp(),
+                        "original url": url,
+                        "response.url": str(response.url),
+                        "http_code": str(http_code),
+                    }
+            except Exception as message:
+                content, http_code = "", -1
+                attributes = {
+                    "error": str(message) or classname(message),
+                    "http_code": str(http_code),
+                    "original url": url,
+                }
+                logging.debug(
+                    f"{classname(self):s}.get({url:s}) - error {attributes['error']:s}"
+                )
+            else:
+                logging.info(f"{classname(self):s}.get({url:s}) - http_code: {http_code:d}")
+        return content, attributes
+
+    async def get_many(
+        self, urls: Iterable[str], backlog: int = BACKLOG
+    ) -> AsyncGenerator[Tuple[str, Dict[Any, Any]], None]:
+        """Yields the result of each url, as they complete.
+        urls is read ahead into a queue per host, up to backlog urls
+        not yet started. A request is started only for a host with a
+        free slot, so a long run of urls of one busy host doesn't keep
+        the other hosts waiting; hosts with queued urls take turns.
+        """
+        queues: Dict[str, Deque[str]] = {}
+        running: Dict[str, int] = {}
+        ready: Deque[str] = deque()  # hosts with queued urls and a free slot
+        is_ready: Set[str] = set()
+        tasks: Dict[asyncio.Task, str] = {}
+        queued = 0
+        iterator = iter(urls)
+        exhausted = False
+
+        def enqueue(host: str) -> None:
+            if queues[host] and running[host] < self.per_host and host not in is_ready:
+                ready.append(host)
+                is_ready.add(host)
+
+        try:
+            while True:
+                while not exhausted and queued < backlog:
+                    url = next(iterator, None)
+                    if url is None:
+                        exhausted = True
+                        break
+                    host = get_host(url)
+                    queues.setdefault(host, deque()).append(url)
+                    running.setdefault(host, 0)
+                    queued += 1
+                    enqueue(host)
+                while ready and len(tasks) < self.concurrency:
+                    host = ready.popleft()
+                    is_ready.discard(host)
+                    url = queues[host].popleft()
+                    queued -= 1
+                    running[host] += 1
+                    tasks[asyncio.ensure_future(self.get(url))] = host
+                    enqueue(host)
+                if not tasks:
+                    break
+                finished, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in finished:
+                    host = tasks.pop(task)
+                    running[host] -= 1
+                    if not queues[host] and not running[host]:
+                        del queues[host], running[host]
+                    else:
+                        enqueue(host)
+                    yield task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+@asynccontextmanager
+async def open_async_scraper(
+    concurrency: int = CONCURRENCY, per_host: int = PER_HOST, timeout: float = 60.0
+) -> AsyncGenerator[AsyncScraper, None]:
+    client = AsyncScraper(concurrency, per_host, timeout)
+    await client.start()
+    try:
+        yield client
+    finally:
+        await client.stop()
+
+
+def scrape(
+    urls: Iterable[str],
+    concurrency: int = CONCURRENCY,
+    per_host: int = PER_HOST,
+    timeout: float = 60.0,
+) -> Generator[Tuple[str, Dict[Any, Any]], None, None]:
+    """get_many for synchronous callers: runs an event loop
+    and yields each result as it completes.
+    """
+
+    async def results() -> AsyncGenerator[Tuple[str, Dict[Any, Any]], None]:
+        async with open_async_scraper(concurrency, per_host, timeout) as client:
+            async for result in client.get_many(urls):
+                yield result
+
+    loop = asyncio.new_event_loop()
+    iterator = results()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(iterator.aclose())
+        loop.close()
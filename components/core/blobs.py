@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Generator, IO, Set, Union
+
+from components.helpers import get_directory, classname
+
+
+CHUNK = 1 << 20
+
+Body = Union[str, bytes, IO[bytes]]
+
+
+def _chunks(body: Union[str, bytes]) -> Generator[bytes, None, None]:
+    """Encodes and slices body piece by piece, never copying it whole."""
+    if isinstance(body, str):
+        for start in range(0, len(body), CHUNK):
+            yield body[start : start + CHUNK].encode("utf-8")
+    else:
+        view = memoryview(body)
+        for start in range(0, len(view), CHUNK):
+            yield view[start : start + CHUNK]
+
+
+class BlobStore:
+    """Content-addressed files: home/ab/abcdef... keyed by sha256.
+    Samples hold references to blobs, see Store.put_blob.
+    Unreferenced blobs are removed by a mark and sweep, see sweep.
+    """
+
+    def __init__(self, home: Path) -> None:
+        self._home: Path = get_directory(home)
+
+    @property
+    def home(self) -> Path:
+        return self._home
+
+    def resource(self, digest: str) -> Path:
+        return Path(self.home, digest[:2], digest)
+
+    def contains(self, digest: str) -> bool:
+        return self.resource(digest).exists()
+
+    def scratch(self) -> Path:
+        return Path(self.home, f".{os.getpid():d}.{threading.get_ident():d}.tmp")
+
+    def put(self, body: Body) -> str:
+        """Stores body and returns its digest.
+        A str or bytes body is hashed first and written only if new.
+        A binary stream is written aside while it is hashed,
+        then renamed into place or dropped if already stored.
+        """
+        if isinstance(body, (str, bytes)):
+            hasher = hashlib.sha256()
+            for chunk in _chunks(body):
+                hasher.update(chunk)
+            digest = hasher.hexdigest()
+            if self.contains(digest):
+                self.touch(digest)
+                return digest
+            scratch = self.scratch()
+            with open(scratch, "wb") as target:
+                for chunk in _chunks(body):
+                    target.write(chunk)
+        else:
+            hasher = hashlib.sha256()
+            scratch = self.scratch()
+            with open(scratch, "wb") as target:
+                for chunk in iter(lambda: body.read(CHUNK), b""):
+                    hasher.update(chunk)
+                    target.write(chunk)
+            digest = hasher.hexdigest()
+            if self.contains(digest):
+                scratch.unlink()
+                self.touch(digest)
+                return digest
+        resource = self.resource(digest)
+        get_directory(resource.parent)
+        os.replace(scratch, resource)
+        return digest
+
+    def touch(self, digest: str) -> None:
+        """A reused blob looks new to a sweep running at the same time."""
+        os.utime(self.resource(digest))
+
+    def open(self, digest: str) -> IO[bytes]:
+        return open(self.resource(digest), "rb")
+
+    def read_bytes(self, digest: str) -> bytes:
+        return self.resource(digest).read_bytes()
+
+    def read_text(self, digest: str) -> str:
+        return self.resource(digest).read_text(encoding="utf-8")
+
+    def digests(self) -> Generator[str, None, None]:
+        with os.scandir(self.home) as prefixes:
+            for prefix in prefixes:
+                if not prefix.is_dir():
+                    continue
+                with os.scandir(prefix.path) as entries:
+                    for entry in entries:
+                        yield entry.name
+
+    def sweep(self, referenced: Set[str], mark: float) -> int:
+        """Removes blobs outside referenced that are older than mark,
+        the time when the referenced set started to be collected.
+        Returns how many blobs were removed.
+        """
+        removed = 0
+        for digest in list(self.digests()):
+            if digest in referenced:
+                continue
+            resource = self.resource(digest)
+            if resource.stat().st_mtime >= mark:
+                continue
+            resource.unlink()
+            removed += 1
+        logging.info(f"{classname(self):s}.sweep: {removed:d} blobs removed")
+        return removed
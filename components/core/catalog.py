@@ -1,4 +1,8 @@
-from typing import Dict, Optional, TypeVar, Generic
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Generator, Optional, Tuple, TypeVar, Generic
+
+from components.core.database import CatalogDatabase
 
 
 class CatalogException(Exception):
@@ -9,16 +13,36 @@ T = TypeVar("T")
 
 
 class Catalog(Generic[T]):
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        database: Optional[Path] = None,
+        encode: Callable[[T], str] = str,
+        decode: Callable[[str], T] = str,
+    ) -> None:
+        """In memory, or in the SQLite file database if given,
+        shared by processes and kept across runs, see CatalogDatabase.
+        encode, decode: a value to and from text, for database
+        """
         self._table: Dict[str, T] = {}  # Internal table for storing data
+        self._database: Optional[CatalogDatabase] = (
+            None if database is None else CatalogDatabase(database)
+        )
+        self._encode = encode
+        self._decode = decode
 
     @property
     def table(self) -> Dict[str, T]:
         """Copy the internal table, preventing modifications"""
+        if self._database is not None:
+            return dict(self.items())
         return self._table.copy()
 
     def create(self, key: str, value: T) -> None:
         """Creates a new entry in the catalog."""
+        if self._database is not None:
+            if not self._database.insert(key, self._encode(value)):
+                raise CatalogException(f"Entry with key '{key:s}' already exists.")
+            return
         try:
             _ = self._table[key]
             raise CatalogException(f"Entry with key '{key:s}' already exists.")
@@ -27,6 +51,10 @@ class Catalog(Generic[T]):
 
     def update(self, key: str, value: T) -> None:
         """Updates an existing entry in the catalog."""
+        if self._database is not None:
+            if not self._database.update(key, self._encode(value)):
+                raise CatalogException(f"Entry with key '{key:s}' not found.")
+            return
         try:
             _ = self._table[key]
             self._table[key] = value
@@ -35,14 +63,55 @@ class Catalog(Generic[T]):
 
     def delete(self, key: str) -> None:
         """Deletes an entry from the catalog."""
+        if self._database is not None:
+            if not self._database.delete(key):
+                raise CatalogException(f"Entry with key '{key:s}' not found.")
+            return
         if key not in self._table:
             raise CatalogException(f"Entry with key '{key:s}' not found.")
         del self._table[key]
 
     def get(self, key: str, on_key_error: Optional[T] = None) -> Optional[T]:
         """Retrieves an entry from the catalog."""
+        if self._database is not None:
+            found = self._database.get(key)
+            return on_key_error if found is None else self._decode(found)
         try:
             value: T = self._table[key]
             return value
         except KeyError:
             return on_key_error
+
+    def items(self, prefix: str = "") -> Generator[Tuple[str, T], None, None]:
+        """Entries whose key starts with prefix, in key order."""
+        if self._database is not None:
+            for key, found in self._database.items(prefix):
+                yield key, self._decode(found)
+            return
+        for key in sorted(self._table):
+            if key.startswith(prefix):
+                yield key, self._table[key]
+
+    def changed_since(self, timestamp: str) -> Generator[Tuple[str, T], None, None]:
+        """Entries created or updated at or after timestamp,
+        a get_timestamp() string. Needs a database.
+        """
+        if self._database is None:
+            raise CatalogException("Catalog.changed_since needs a database.")
+        for key, found, _ in self._database.changed_since(timestamp):
+            yield key, self._decode(found)
+
+    @contextmanager
+    def transaction(self) -> Generator[None, None, None]:
+        """Commits the writes inside at once, or none of them.
+        In memory, writes are applied as they come.
+        """
+        if self._database is None:
+            yield
+            return
+        with self._database.transaction():
+            yield
+
+    def close(self) -> None:
+        if self._database is not None:
+            self._database.close()
@@ -0,0 +1,137 @@
+import json
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Generator, Optional, Protocol
+
+# optional, faster json backends
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+CHUNK = 1 << 22
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec(Protocol):
+    """Encodes and decodes one json line, without its newline."""
+
+    @property
+    def name(self) -> str:
+        ...
+
+    def loads(self, line: bytes) -> Any:
+        ...
+
+    def dumps(self, value: Any) -> bytes:
+        ...
+
+
+class StdlibCodec:
+    @property
+    def name(self) -> str:
+        return "json"
+
+    def loads(self, line: bytes) -> Any:
+        return json.loads(line)
+
+    def dumps(self, value: Any) -> bytes:
+        return json.dumps(value).encode("utf-8")
+
+
+class OrjsonCodec:
+    @property
+    def name(self) -> str:
+        return "orjson"
+
+    def loads(self, line: bytes) -> Any:
+        return orjson.loads(line)
+
+    def dumps(self, value: Any) -> bytes:
+        return orjson.dumps(value)
+
+
+class MsgspecCodec:
+    def __init__(self) -> None:
+        self._decoder = msgspec.json.Decoder()
+        self._encoder = msgspec.json.Encoder()
+
+    @property
+    def name(self) -> str:
+        return "msgspec"
+
+    def loads(self, line: bytes) -> Any:
+        return self._decoder.decode(line)
+
+    def dumps(self, value: Any) -> bytes:
+        return self._encoder.encode(value)
+
+
+CODECS: Dict[str, Callable[[], Codec]] = {"json": StdlibCodec}
+if msgspec is not None:
+    CODECS["msgspec"] = MsgspecCodec
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec
+
+# fastest first
+PREFERENCE = ("orjson", "msgspec", "json")
+
+
+def get_codec(name: Optional[str] = None) -> Codec:
+    """The named codec, or the fastest one installed if name is None."""
+    if name is None:
+        name = next(n for n in PREFERENCE if n in CODECS)
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise CodecError(f"get_codec: {name:s} is not available")
+
+
+def read_lines(resource: Path, chunk: int = CHUNK) -> Generator[bytes, None, None]:
+    """Yields the non empty lines of resource, without newlines,
+    reading it in large binary chunks.
+    """
+    with open(resource, "rb") as origin:
+        rest = b""
+        while True:
+            block = origin.read(chunk)
+            if not block:
+                break
+            lines = (rest + block).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                if line:
+                    yield line
+        if rest.strip():
+            yield rest
+
+
+def stringify(message: Dict[str, Any]) -> Dict[str, str]:
+    """A message has str values, convert them only when needed."""
+    for value in message.values():
+        if type(value) is not str:
+            return {str(k): str(v) for k, v in message.items()}
+    return message
+
+
+def benchmark(resource: Path) -> Dict[str, float]:
+    """Messages per second decoded from resource by each codec."""
+    rates: Dict[str, float] = {}
+    for name in CODECS:
+        codec = get_codec(name)
+        start_time = time.perf_counter()
+        count = 0
+        for line in read_lines(resource):
+            stringify(codec.loads(line))
+            count += 1
+        rates[name] = count / max(time.perf_counter() - start_time, 1e-9)
+    return rates
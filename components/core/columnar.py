@@ -0,0 +1,95 @@
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+# optional, needed only for columnar output
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class ColumnarError(Exception):
+    pass
+
+
+# suffix of each columnar form
+COLUMNAR = {"parquet": ".parquet", "arrow": ".arrow"}
+
+ROW_GROUP = 1 << 16
+
+
+def _check(form: str) -> None:
+    if pyarrow is None:
+        raise ColumnarError("columnar: pyarrow is not installed")
+    if form not in COLUMNAR:
+        raise ColumnarError(f"columnar: unknown form {form:s}")
+
+
+def _arrow_type(name: str) -> Any:
+    return {
+        "int": pyarrow.int64(),
+        "float": pyarrow.float64(),
+        "bool": pyarrow.bool_(),
+    }.get(name, pyarrow.string())
+
+
+def _convert(value: Any, name: str) -> Any:
+    if value is None:
+        return None
+    if name == "float":
+        return float(value)
+    if name in ("int", "bool"):
+        return value
+    return value if isinstance(value, str) else str(value)
+
+
+def write_columns(
+    resource: Path,
+    form: str,
+    types: Dict[str, str],
+    messages: Iterable[Dict[str, Any]],
+    row_group: int = ROW_GROUP,
+) -> None:
+    """Writes messages as columns of the given types, a missing key
+    is a null. Only row_group messages are held in memory at once.
+    """
+    _check(form)
+    schema = pyarrow.schema([(key, _arrow_type(name)) for key, name in types.items()])
+    scratch = resource.with_name(f"{resource.name:s}.tmp")
+    if form == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(scratch, schema)
+    else:
+        writer = pyarrow.ipc.new_file(str(scratch), schema)
+    iterator = iter(messages)
+    try:
+        while True:
+            group = list(islice(iterator, row_group))
+            if not group:
+                break
+            columns = {
+                key: [_convert(message.get(key), name) for message in group]
+                for key, name in types.items()
+            }
+            batch = pyarrow.RecordBatch.from_pydict(columns, schema=schema)
+            if form == "parquet":
+                writer.write_batch(batch, row_group_size=row_group)
+            else:
+                writer.write_batch(batch)
+    finally:
+        writer.close()
+    scratch.replace(resource)
+
+
+def read_columns(resource: Path, form: str, columns: Optional[List[str]] = None) -> Any:
+    """A pyarrow.Table of the given columns, all if None.
+    An arrow file is memory-mapped and read without copies.
+    """
+    _check(form)
+    if form == "parquet":
+        return pyarrow.parquet.read_table(resource, columns=columns, memory_map=True)
+    source = pyarrow.memory_map(str(resource), "r")
+    table = pyarrow.ipc.open_file(source).read_all()
+    return table if columns is None else table.select(columns)
@@ -0,0 +1,215 @@
+from contextlib import contextmanager
+import json
+from pathlib import Path
+import sqlite3
+from typing import Dict, Generator, List, Optional, Tuple
+
+from components.helpers import get_timestamp
+
+
+# rows written by a Metadata engine in a transaction
+BATCH = 1 << 10
+
+# rows fetched at once by the query generators
+FETCH = 1 << 10
+
+
+def connect(resource: Path, threads: bool = False) -> sqlite3.Connection:
+    """A connection in WAL mode: readers in other processes aren't
+    blocked by a writer, and writers wait for each other up to timeout.
+    Transactions are explicit, see transaction().
+    threads: usable from any thread, the caller serializes the calls
+    """
+    connection = sqlite3.connect(
+        resource, timeout=60.0, isolation_level=None, check_same_thread=not threads
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+@contextmanager
+def transaction(connection: sqlite3.Connection) -> Generator[None, None, None]:
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+
+def fetch(cursor: sqlite3.Cursor) -> Generator[Tuple, None, None]:
+    while rows := cursor.fetchmany(FETCH):
+        yield from rows
+
+
+class MetadataDatabase:
+    """Metadata records in a SQLite table, a row per
+    (identifier, attribute), with the json value and the
+    get_timestamp() of its last change. Writes are buffered
+    and committed batch rows at a time.
+    """
+
+    def __init__(self, resource: Path, batch: int = BATCH) -> None:
+        self._resource: Path = resource
+        self._batch: int = batch
+        self._pending: List[Tuple[str, str, str, str]] = []
+        self._connection: sqlite3.Connection = connect(resource)
+        with transaction(self._connection):
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "identifier TEXT NOT NULL, attribute TEXT NOT NULL, "
+                "value TEXT NOT NULL, changed TEXT NOT NULL, "
+                "PRIMARY KEY (identifier, attribute)) WITHOUT ROWID"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS records_attribute "
+                "ON records (attribute, identifier)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS records_changed ON records (changed)"
+            )
+
+    @property
+    def resource(self) -> Path:
+        return self._resource
+
+    def put(self, identifier: str, attribute: str, value: Dict) -> None:
+        self._pending.append((identifier, attribute, json.dumps(value), get_timestamp()))
+        if len(self._pending) >= self._batch:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        with transaction(self._connection):
+            self._connection.executemany(
+                "INSERT INTO records (identifier, attribute, value, changed) "
+                "VALUES (?, ?, ?, ?) ON CONFLICT (identifier, attribute) "
+                "DO UPDATE SET value = excluded.value, changed = excluded.changed",
+                self._pending,
+            )
+        self._pending = []
+
+    def close(self) -> None:
+        self.flush()
+        self._connection.close()
+
+    def count(self) -> int:
+        self.flush()
+        return self._connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def get(self, identifier: str, attribute: str) -> Optional[Dict]:
+        self.flush()
+        row = self._connection.execute(
+            "SELECT value FROM records WHERE identifier = ? AND attribute = ?",
+            (identifier, attribute),
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def items(self) -> Generator[Tuple[str, str, Dict], None, None]:
+        self.flush()
+        cursor = self._connection.execute(
+            "SELECT identifier, attribute, value FROM records"
+        )
+        for identifier, attribute, value in fetch(cursor):
+            yield identifier, attribute, json.loads(value)
+
+    def identifiers(self, attribute: str) -> Generator[str, None, None]:
+        self.flush()
+        cursor = self._connection.execute(
+            "SELECT identifier FROM records WHERE attribute = ?", (attribute,)
+        )
+        for (identifier,) in fetch(cursor):
+            yield identifier
+
+    def changed_since(
+        self, timestamp: str
+    ) -> Generator[Tuple[str, str, Dict, str], None, None]:
+        self.flush()
+        cursor = self._connection.execute(
+            "SELECT identifier, attribute, value, changed FROM records "
+            "WHERE changed >= ? ORDER BY changed",
+            (timestamp,),
+        )
+        for identifier, attribute, value, changed in fetch(cursor):
+            yield identifier, attribute, json.loads(value), changed
+
+
+class CatalogDatabase:
+    """Catalog entries in a SQLite table, values encoded as text.
+    Each write commits unless inside transaction().
+    """
+
+    def __init__(self, resource: Path) -> None:
+        self._resource: Path = resource
+        self._connection: sqlite3.Connection = connect(resource)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, changed TEXT NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_changed ON entries (changed)"
+        )
+
+    @property
+    def resource(self) -> Path:
+        return self._resource
+
+    @contextmanager
+    def transaction(self) -> Generator[None, None, None]:
+        if self._connection.in_transaction:
+            yield
+            return
+        with transaction(self._connection):
+            yield
+
+    def insert(self, key: str, value: str) -> bool:
+        """False if key exists."""
+        try:
+            self._connection.execute(
+                "INSERT INTO entries (key, value, changed) VALUES (?, ?, ?)",
+                (key, value, get_timestamp()),
+            )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def update(self, key: str, value: str) -> bool:
+        """False if key doesn't exist."""
+        cursor = self._connection.execute(
+            "UPDATE entries SET value = ?, changed = ? WHERE key = ?",
+            (value, get_timestamp(), key),
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, key: str) -> bool:
+        """False if key doesn't exist."""
+        cursor = self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+        return cursor.rowcount > 0
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connection.execute(
+            "SELECT value FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def items(self, prefix: str = "") -> Generator[Tuple[str, str], None, None]:
+        """Entries in key order, those whose key starts with prefix."""
+        # the primary key index answers a range over keys
+        cursor = self._connection.execute(
+            "SELECT key, value FROM entries WHERE key >= ? AND key < ? ORDER BY key",
+            (prefix, prefix + "\U0010ffff"),
+        )
+        yield from fetch(cursor)
+
+    def changed_since(self, timestamp: str) -> Generator[Tuple[str, str, str], None, None]:
+        cursor = self._connection.execute(
+            "SELECT key, value, changed FROM entries WHERE changed >= ? ORDER BY changed",
+            (timestamp,),
+        )
+        yield from fetch(cursor)
+
+    def close(self) -> None:
+        self._connection.close()
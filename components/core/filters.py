@@ -0,0 +1,148 @@
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, Set, Tuple
+
+# optional, needed only for masks
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _like(column: Any, value: Any) -> Any:
+    """value as an element of column, an array of vectors.read_chunks."""
+    if column.dtype.kind == "b":
+        return value in (True, "True")
+    if column.dtype.kind in "iuf":
+        return column.dtype.type(value)
+    return str(value)
+
+
+class Filter(ABC):
+    """Declarative, picklable predicate over a message.
+    Filters can be sent to worker processes, and a document
+    may answer them from an index instead of a scan.
+    mask() applies the predicate to a chunk of column arrays at once.
+    """
+
+    @abstractmethod
+    def __call__(self, message: Dict[str, str]) -> bool:
+        ...
+
+    @abstractmethod
+    def fields(self) -> Set[str]:
+        """The fields the predicate reads."""
+        ...
+
+    @abstractmethod
+    def mask(self, columns: Dict[str, Any]) -> Any:
+        ...
+
+    def __and__(self, other: "Filter") -> "All":
+        return All(self, other)
+
+
+class Equals(Filter):
+    def __init__(self, field: str, value: str) -> None:
+        self.field = field
+        self.value = value
+
+    def __call__(self, message: Dict[str, str]) -> bool:
+        return message.get(self.field) == self.value
+
+    def fields(self) -> Set[str]:
+        return {self.field}
+
+    def mask(self, columns: Dict[str, Any]) -> Any:
+        column = columns[self.field]
+        return column == _like(column, self.value)
+
+    def __repr__(self) -> str:
+        return f"Equals({self.field!r}, {self.value!r})"
+
+
+class In(Filter):
+    def __init__(self, field: str, values: Iterable[str]) -> None:
+        self.field = field
+        self.values = frozenset(values)
+
+    def __call__(self, message: Dict[str, str]) -> bool:
+        return message.get(self.field) in self.values
+
+    def fields(self) -> Set[str]:
+        return {self.field}
+
+    def mask(self, columns: Dict[str, Any]) -> Any:
+        column = columns[self.field]
+        return numpy.isin(column, [_like(column, value) for value in self.values])
+
+    def __repr__(self) -> str:
+        return f"In({self.field!r}, {sorted(self.values)!r})"
+
+
+class Prefix(Filter):
+    def __init__(self, field: str, prefix: str) -> None:
+        self.field = field
+        self.prefix = prefix
+
+    def __call__(self, message: Dict[str, str]) -> bool:
+        value = message.get(self.field)
+        return value is not None and value.startswith(self.prefix)
+
+    def fields(self) -> Set[str]:
+        return {self.field}
+
+    def mask(self, columns: Dict[str, Any]) -> Any:
+        column = columns[self.field]
+        if column.dtype == object:
+            starts = (value.startswith(self.prefix) for value in column)
+            return numpy.fromiter(starts, dtype=bool, count=len(column))
+        return numpy.char.startswith(column.astype(str), self.prefix)
+
+    def __repr__(self) -> str:
+        return f"Prefix({self.field!r}, {self.prefix!r})"
+
+
+class All(Filter):
+    def __init__(self, *conditions: Filter) -> None:
+        self.conditions: Tuple[Filter, ...] = conditions
+
+    def __call__(self, message: Dict[str, str]) -> bool:
+        return all(condition(message) for condition in self.conditions)
+
+    def fields(self) -> Set[str]:
+        return set().union(*(condition.fields() for condition in self.conditions))
+
+    def mask(self, columns: Dict[str, Any]) -> Any:
+        found = self.conditions[0].mask(columns)
+        for condition in self.conditions[1:]:
+            found = found & condition.mask(columns)
+        return found
+
+    def __repr__(self) -> str:
+        return f"All{self.conditions!r}"
+
+
+class Between(Filter):
+    """low <= value <= high, comparing strings,
+    as for get_timestamp() values. mask() compares
+    as the column type, numbers for a numeric column.
+    """
+
+    def __init__(self, field: str, low: str, high: str) -> None:
+        self.field = field
+        self.low = low
+        self.high = high
+
+    def __call__(self, message: Dict[str, str]) -> bool:
+        value = message.get(self.field)
+        return value is not None and self.low <= value <= self.high
+
+    def fields(self) -> Set[str]:
+        return {self.field}
+
+    def mask(self, columns: Dict[str, Any]) -> Any:
+        column = columns[self.field]
+        return (column >= _like(column, self.low)) & (column <= _like(column, self.high))
+
+    def __repr__(self) -> str:
+        return f"Between({self.field!r}, {self.low!r}, {self.high!r})"
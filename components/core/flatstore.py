@@ -1,10 +1,16 @@
 from logging import error
-import glob
+from bisect import bisect_right, insort
+from itertools import islice
+import os
 from pathlib import Path
-from typing import Generator, Optional, List
+from typing import Generator, Optional, List, Tuple
 
 from components.core.store import Store
-from components.helpers import get_timestamp, get_container, classname
+from components.helpers import get_timestamp, get_container, get_directory, get_resource, classname
+
+
+# compact keys.log into keys.txt after this many appended keys
+KEY_LOG_LIMIT = 4096
 
 
 def _get_sample_home(samples: Path, identifier: str) -> Path:
@@ -12,23 +18,120 @@ def _get_sample_home(samples: Path, identifier: str) -> Path:
 
 
 class FlatStore(Store):
-    def __init__(self, container: Path, identifier: str) -> None:
+    def __init__(self, container: Path, identifier: str, key_index: bool = False) -> None:
+        """
+        key_index: keep the sorted sample keys in keys.txt (plus keys.log,
+            appended by sample_home), so that listing a large store
+            doesn't need to scan the samples directory
+        """
         super().__init__(container, identifier)
         self._samples = get_container(self.home, "samples")
+        self._key_index = key_index
+        self._keys_txt = get_resource(self.home, "keys", ".txt")
+        self._keys_log = get_resource(self.home, "keys", ".log")
+        self._key_log_size = 0
+        # sorted sample keys, valid while samples has this mtime
+        self._keys: Optional[List[str]] = None
+        self._keys_mtime = -1
 
     @property
     def samples(self) -> Path:
         return self._samples
 
+    @property
+    def key_index(self) -> bool:
+        return self._key_index
+
     def sorted_sample_keys(self) -> List[str]:
-        alpha = [dd for dd in glob.glob(f"{str(self.samples):s}/*")]
-        bravo = sorted(alpha)
-        charlie = [Path(dd).stem for dd in bravo]
-        return charlie
-    
+        return [Path(key).stem for key in self.sorted_keys()]
+
+    def keys(
+        self, start_after: Optional[str] = None, limit: Optional[int] = None
+    ) -> Generator[str, None, None]:
+        """Yields sample keys in order, a page at a time:
+        only keys greater than start_after, at most limit of them.
+        """
+        keys = self.sorted_keys()
+        start = 0 if start_after is None else bisect_right(keys, start_after)
+        stop = None if limit is None else start + limit
+        yield from islice(keys, start, stop)
+
     def iterate(self) -> Generator[Path, None, None]:
-        for dd in glob.glob(f"{str(self.samples):s}/*"):
-            yield Path(dd)
+        for key in self.sorted_keys():
+            yield Path(self.samples, key)
 
     def sample_home(self, key: str) -> Path:
-        return get_container(self.samples, key)
+        sample_home = Path(self.samples, key)
+        if sample_home.exists():
+            return sample_home
+        in_sync = self._keys is not None and self._keys_mtime == self.mtime()
+        get_directory(sample_home)
+        if in_sync:
+            insort(self._keys, key)
+            self._keys_mtime = self.mtime()
+            if self.key_index:
+                self.append_key(key)
+        else:
+            self._keys = None
+        return sample_home
+
+    def mtime(self) -> int:
+        return os.stat(self.samples).st_mtime_ns
+
+    def sorted_keys(self) -> List[str]:
+        """Sorted sample keys, cached until samples is modified."""
+        mtime = self.mtime()
+        if self._keys is not None and self._keys_mtime == mtime:
+            return self._keys
+        keys = self.read_key_index(mtime) if self.key_index else None
+        if keys is None:
+            with os.scandir(self.samples) as entries:
+                # like glob("*"), skip hidden entries
+                keys = sorted(e.name for e in entries if not e.name.startswith("."))
+            if self.key_index:
+                self.write_key_index(keys, mtime)
+        self._keys, self._keys_mtime = keys, mtime
+        return keys
+
+    def read_key_index(self, mtime: int) -> Optional[List[str]]:
+        """The keys in keys.txt and keys.log, or None when they are
+        missing or were not recorded at this mtime of samples.
+        """
+        if not self._keys_txt.exists():
+            return None
+        with open(self._keys_txt, "r", encoding="utf-8") as source:
+            recorded = int(source.readline())
+            keys = [line.rstrip("\n") for line in source]
+        appended: List[Tuple[str, int]] = []
+        if self._keys_log.exists():
+            with open(self._keys_log, "r", encoding="utf-8") as source:
+                for line in source:
+                    key, _, key_mtime = line.rstrip("\n").rpartition("\t")
+                    appended.append((key, int(key_mtime)))
+        if appended:
+            recorded = appended[-1][1]
+        if recorded != mtime:
+            return None
+        for key, _ in appended:
+            insort(keys, key)
+        self._key_log_size = len(appended)
+        return keys
+
+    def write_key_index(self, keys: List[str], mtime: int) -> None:
+        scratch = self._keys_txt.with_suffix(".tmp")
+        with open(scratch, "w", encoding="utf-8") as target:
+            target.write(f"{mtime:d}\n")
+            for key in keys:
+                target.write(f"{key:s}\n")
+        os.replace(scratch, self._keys_txt)
+        if self._keys_log.exists():
+            self._keys_log.unlink()
+        self._key_log_size = 0
+
+    def append_key(self, key: str) -> None:
+        if self._key_log_size >= KEY_LOG_LIMIT:
+            self.write_key_index(self._keys, self._keys_mtime)
+            return
+        with open(self._keys_log, "a", encoding="utf-8") as target:
+            target.write(f"{key:s}\t{self._keys_mtime:d}\n")
+        self._key_log_size += 1
@@ -0,0 +1,211 @@
+from hashlib import sha256
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional, Protocol
+
+from components.helpers import get_directory
+from components.core.database import connect, transaction
+
+
+# bytes of bodies kept by a DiskCache
+BUDGET = 1 << 30
+
+
+class HttpCache(Protocol):
+    """Abstract protocol for the response cache of Scraper."""
+
+    def lookup(self, url: str) -> Optional[Dict[str, Any]]:
+        """The entry of url: "etag", "last_modified", "stored",
+        "max_age", "response.url" and "http_code", or None.
+        """
+        ...
+
+    def read(self, url: str) -> Optional[str]:
+        """The cached body of url, or None."""
+        ...
+
+    def store(
+        self, url: str, content: str, headers: Mapping[str, str], attributes: Dict[str, str]
+    ) -> None:
+        """Keeps a response, unless its Cache-Control forbids it."""
+        ...
+
+    def refresh(self, url: str, headers: Mapping[str, str]) -> None:
+        """Restarts the freshness of url after a 304 response."""
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+def cache_control(headers: Mapping[str, str]) -> Dict[str, Optional[str]]:
+    """The directives of a Cache-Control header, {"max-age": "60", "no-store": None}."""
+    directives: Dict[str, Optional[str]] = {}
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"') or None
+    return directives
+
+
+def max_age(headers: Mapping[str, str]) -> float:
+    """Seconds a response is fresh for, 0 means revalidate it every time."""
+    directives = cache_control(headers)
+    if "no-cache" in directives:
+        return 0.0
+    try:
+        return float(directives.get("s-maxage") or directives.get("max-age") or 0)
+    except ValueError:
+        return 0.0
+
+
+def is_fresh(entry: Dict[str, Any]) -> bool:
+    return time.time() - entry["stored"] < entry["max_age"]
+
+
+class DiskCache:
+    """HttpCache in a directory: bodies in bodies/ab/<sha256 of url>,
+    entries in cache.sqlite. Past budget bytes of bodies, the least
+    recently used entries are evicted; the bytes are summed on open,
+    then counted as this cache stores and evicts.
+    Safe to share between threads, one call at a time.
+    """
+
+    def __init__(self, directory: Path, budget: int = BUDGET) -> None:
+        self._directory: Path = get_directory(directory)
+        self._bodies: Path = get_directory(Path(self.directory, "bodies"))
+        self._budget: int = budget
+        self._lock = threading.RLock()
+        self._connection = connect(Path(self.directory, "cache.sqlite"), threads=True)
+        with transaction(self._connection):
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+                "stored REAL NOT NULL, max_age REAL NOT NULL, "
+                "response_url TEXT, http_code TEXT, "
+                "size INTEGER NOT NULL, used REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_used ON entries (used)"
+            )
+        self._size: int = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+
+    @property
+    def directory(self) -> Path:
+        return self._directory
+
+    @property
+    def budget(self) -> int:
+        return self._budget
+
+    def body(self, url: str) -> Path:
+        digest = sha256(url.encode("utf-8")).hexdigest()
+        return Path(self._bodies, digest[:2], digest)
+
+    def lookup(self, url: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT etag, last_modified, stored, max_age, response_url, http_code "
+                "FROM entries WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ("etag", "last_modified", "stored", "max_age", "response.url", "http_code")
+        return dict(zip(keys, row))
+
+    def read(self, url: str) -> Optional[str]:
+        try:
+            content = self.body(url).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._connection.execute(
+                "UPDATE entries SET used = ? WHERE url = ?", (time.time(), url)
+            )
+        return content
+
+    def store(
+        self, url: str, content: str, headers: Mapping[str, str], attributes: Dict[str, str]
+    ) -> None:
+        if "no-store" in cache_control(headers):
+            return
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        freshness = max_age(headers)
+        if etag is None and last_modified is None and not freshness:
+            # could never be served again
+            return
+        body = self.body(url)
+        body.parent.mkdir(exist_ok=True)
+        data = content.encode("utf-8")
+        # one per writer, threads may store the same url at once
+        scratch = body.with_name(f"{body.name:s}.{os.getpid():d}.{threading.get_ident():d}.tmp")
+        scratch.write_bytes(data)
+        os.replace(scratch, body)
+        now = time.time()
+        with self._lock, transaction(self._connection):
+            row = self._connection.execute(
+                "SELECT size FROM entries WHERE url = ?", (url,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    etag,
+                    last_modified,
+                    now,
+                    freshness,
+                    attributes.get("response.url", url),
+                    attributes.get("http_code", "200"),
+                    len(data),
+                    now,
+                ),
+            )
+            self._size += len(data) - (0 if row is None else row[0])
+        self.evict()
+
+    def refresh(self, url: str, headers: Mapping[str, str]) -> None:
+        """A 304 without Cache-Control keeps the max-age stored."""
+        freshness = max_age(headers) if "Cache-Control" in headers else None
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "UPDATE entries SET stored = ?, used = ?, "
+                "max_age = COALESCE(?, max_age), etag = COALESCE(?, etag), "
+                "last_modified = COALESCE(?, last_modified) WHERE url = ?",
+                (now, now, freshness, headers.get("ETag"), headers.get("Last-Modified"), url),
+            )
+
+    def size(self) -> int:
+        return self._size
+
+    def evict(self) -> None:
+        """Removes least recently used entries until under budget."""
+        with self._lock:
+            excess = self.size() - self.budget
+            if excess <= 0:
+                return
+            cursor = self._connection.execute(
+                "SELECT url, size FROM entries ORDER BY used"
+            )
+            evicted = []
+            for url, size in cursor:
+                evicted.append(url)
+                excess -= size
+                self._size -= size
+                if excess <= 0:
+                    break
+            with transaction(self._connection):
+                self._connection.executemany(
+                    "DELETE FROM entries WHERE url = ?", [(url,) for url in evicted]
+                )
+        for url in evicted:
+            self.body(url).unlink(missing_ok=True)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
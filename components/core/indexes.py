@@ -0,0 +1,181 @@
+from array import array
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from components.core.codecs import Codec
+from components.core.filters import All, Equals, Filter, In
+from components.core.offsets import locked
+
+
+# records of older versions are rebuilt: version 1 skipped null values
+VERSION = 2
+
+
+class FieldIndex:
+    """Secondary index of a jsonl document: for one field,
+    each value mapped to the offsets of the messages holding it.
+    The index file is append-only, one json record per batch:
+        {"version": VERSION,
+         "end": where the indexed part of the document ends,
+         "values": {value: [offsets]}}
+    Values are keyed as stringify() renders them, null as "None",
+    so that lookups match what a scan of the messages matches.
+    Readers and writers, in any process, extend the file under an
+    fcntl lock on the .lock file next to it.
+    """
+
+    def __init__(self, resource: Path, document: Path, field: str, codec: Codec) -> None:
+        self._resource: Path = resource
+        self._document: Path = document
+        self._lock: Path = resource.with_suffix(".lock")
+        self._field: str = field
+        self._codec: Codec = codec
+        self._table: Dict[str, array] = {}
+        self._end: int = 0
+        self._read: int = 0  # bytes of the index file already loaded
+        self._seconds: float = 0.0
+
+    @property
+    def resource(self) -> Path:
+        return self._resource
+
+    @property
+    def lock(self) -> Path:
+        return self._lock
+
+    @property
+    def field(self) -> str:
+        return self._field
+
+    @property
+    def end(self) -> int:
+        return self._end
+
+    def load(self) -> None:
+        """Merges the records appended to the index file since last load."""
+        if not self.resource.exists():
+            return
+        with open(self.resource, "rb") as source:
+            source.seek(self._read)
+            for line in source:
+                if not line.endswith(b"\n"):
+                    # a torn record, the next sync indexes it again
+                    break
+                record = json.loads(line)
+                if record.get("version") != VERSION:
+                    logging.warning(f"FieldIndex: {str(self.resource):s} outdated, rebuilt")
+                    self.clear()
+                    return
+                self._read += len(line)
+                if record["end"] <= self._end:
+                    # already indexed, by a reader and a writer at once
+                    continue
+                self.merge(record["values"])
+                self._end = record["end"]
+
+    def merge(self, values: Dict[str, Iterable[int]]) -> None:
+        for value, offsets in values.items():
+            try:
+                self._table[value].extend(offsets)
+            except KeyError:
+                self._table[value] = array("Q", offsets)
+
+    def append(self, values: Dict[str, List[int]], start: int, end: int) -> None:
+        """Adds the values of messages just written to the document,
+        from start to end, unless a sync indexed them already. When
+        they don't start where the index ends, the document is
+        indexed from there.
+        """
+        with locked(self.lock):
+            self.load()
+            if self.end == start:
+                self.write(values, end)
+            elif self.end < end:
+                self.index()
+
+    def write(self, values: Dict[str, List[int]], end: int) -> None:
+        record = {"version": VERSION, "end": end, "values": values}
+        with open(self.resource, "a", encoding="utf-8") as target:
+            target.write(f"{json.dumps(record):s}\n")
+            self._read = target.tell()
+        self.merge(values)
+        self._end = end
+
+    def clear(self) -> None:
+        if self.resource.exists():
+            self.resource.unlink()
+        self._table, self._end, self._read = {}, 0, 0
+
+    def sync(self) -> None:
+        """Loads the index, then indexes the part of the document
+        written without it. Rebuilds when the document is shorter.
+        """
+        with locked(self.lock):
+            self.index()
+
+    def index(self) -> None:
+        """sync, the lock held."""
+        self.load()
+        size = os.path.getsize(self._document) if self._document.exists() else 0
+        if size < self.end:
+            logging.warning(f"FieldIndex: {str(self.resource):s} rebuilt")
+            self.clear()
+        if size == self.end:
+            return
+        start_time = time.perf_counter()
+        values: Dict[str, List[int]] = {}
+        loads = self._codec.loads
+        with open(self._document, "rb") as source:
+            source.seek(self.end)
+            position = self.end
+            for line in source:
+                if not line.endswith(b"\n"):
+                    break
+                stripped = line.rstrip(b"\n")
+                if stripped:
+                    message = loads(stripped)
+                    if self.field in message:
+                        values.setdefault(str(message[self.field]), []).append(position)
+                position += len(line)
+        self.write(values, position)
+        self._seconds += time.perf_counter() - start_time
+
+    def lookup(self, value: str) -> array:
+        return self._table.get(value, array("Q"))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "values": len(self._table),
+            "entries": sum(len(offsets) for offsets in self._table.values()),
+            "bytes": os.path.getsize(self.resource) if self.resource.exists() else 0,
+            "memory": sum(o.itemsize * len(o) for o in self._table.values()),
+            "seconds": self._seconds,
+        }
+
+
+def plan(select: Filter, indexes: Dict[str, FieldIndex]) -> Optional[array]:
+    """Offsets of the messages that may match select, from indexes,
+    or None when select can't be answered by them.
+    """
+    if isinstance(select, Equals) and select.field in indexes:
+        return indexes[select.field].lookup(select.value)
+    if isinstance(select, In) and select.field in indexes:
+        index = indexes[select.field]
+        found = set()
+        for value in select.values:
+            found.update(index.lookup(value))
+        return array("Q", sorted(found))
+    if isinstance(select, All):
+        candidates: Optional[set] = None
+        for condition in select.conditions:
+            offsets = plan(condition, indexes)
+            if offsets is None:
+                continue
+            candidates = set(offsets) if candidates is None else candidates & set(offsets)
+        if candidates is not None:
+            return array("Q", sorted(candidates))
+    return None
@@ -1,8 +1,32 @@
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from contextlib import contextmanager
 import json
+import logging
+import os
+import threading
+import time
 from pathlib import Path
-from typing import Dict, Protocol, Any, Generator, List, DefaultDict, Callable
+from typing import (
+    Dict,
+    Protocol,
+    Any,
+    Generator,
+    List,
+    DefaultDict,
+    Callable,
+    Optional,
+    Deque,
+    Tuple,
+    Iterable,
+)
 
 from components.helpers import get_directory, get_resource
+from components.core.codecs import CHUNK, Codec, get_codec, read_lines, stringify
+from components.core.offsets import OffsetIndex
+from components.core.filters import Filter
+from components.core.indexes import FieldIndex, plan
 from collections import Counter
 
 
@@ -22,13 +46,106 @@ class MessageGenerator(Protocol):
         ...
 
 
+# bytes of messages.jsonl scanned by a worker at once, see MessageDocument.scan
+PART = 1 << 24
+
+# write buffer of MessageWriter
+BUFFER = 1 << 20
+
+# seconds a message waits in the batch of an idle MessageWriter
+LINGER = 1.0
+
+
+def read_range(resource: Path, start: int, stop: int) -> Generator[bytes, None, None]:
+    """The lines starting in [start, stop) without their newline.
+    A line crossing start belongs to the previous range.
+    """
+    with open(resource, "rb") as origin:
+        if start > 0:
+            origin.seek(start - 1)
+            origin.readline()
+        position = origin.tell()
+        while position < stop:
+            line = origin.readline()
+            if not line:
+                break
+            position += len(line)
+            line = line.rstrip(b"\n")
+            if line:
+                yield line
+
+
+def get_ranges(resource: Path, part: int) -> Generator[Tuple[int, int], None, None]:
+    size = os.path.getsize(resource)
+    return ((start, min(start + part, size)) for start in range(0, size, part))
+
+
+def _scan(
+    resource: Path,
+    codec: str,
+    start: int,
+    stop: int,
+    select: Callable[[Dict[str, str]], bool],
+) -> List[Dict[str, str]]:
+    """The messages accepted by select among the lines starting
+    in [start, stop).
+    """
+    loads = get_codec(codec).loads
+    selected: List[Dict[str, str]] = []
+    for line in read_range(resource, start, stop):
+        message = stringify(loads(line))
+        if select(message):
+            selected.append(message)
+    return selected
+
+
+def _finished(
+    pending: Deque[Future], ordered: bool
+) -> Generator[Dict[str, str], None, None]:
+    """Waits for the oldest scan if ordered, else for any of them,
+    and yields its messages.
+    """
+    if ordered:
+        yield from pending.popleft().result()
+        return
+    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in finished:
+        pending.remove(future)
+        yield from future.result()
+
+
 class MessageDocument:
     """messages in a file"""
 
-    def __init__(self, directory: Path) -> None:
-        """Initializes the document with its directory and store file path."""
+    def __init__(
+        self,
+        directory: Path,
+        codec: Optional[str] = None,
+        offsets: bool = False,
+        indexes: Tuple[str, ...] = (),
+    ) -> None:
+        """Initializes the document with its directory and store file path.
+        codec: json backend (see codecs.get_codec), the fastest if None.
+        offsets: maintain messages.offsets on update(), see OffsetIndex.
+        indexes: fields with a secondary index, messages.<field>.index,
+            that where() uses for Equals and In filters, see FieldIndex.
+        """
         self._directory: Path = get_directory(directory)
         self._resource: Path = get_resource(self.directory, "messages", ".jsonl")
+        self._codec: Codec = get_codec(codec)
+        self._offsets: OffsetIndex = OffsetIndex(
+            get_resource(self.directory, "messages", ".offsets"), self.resource
+        )
+        self._maintain_offsets: bool = offsets
+        self._indexes: Dict[str, FieldIndex] = {
+            field: FieldIndex(
+                Path(self.directory, f"messages.{field:s}.index"),
+                self.resource,
+                field,
+                self.codec,
+            )
+            for field in indexes
+        }
 
     @property
     def directory(self) -> Path:
@@ -40,35 +157,379 @@ class MessageDocument:
         """Returns the path to the document"s store file."""
         return self._resource
 
+    @property
+    def codec(self) -> Codec:
+        """Returns the json backend of the document."""
+        return self._codec
+
+    @property
+    def offsets(self) -> OffsetIndex:
+        """Returns the byte offset index of the document."""
+        return self._offsets
+
+    @property
+    def maintain_offsets(self) -> bool:
+        """Tells if writes extend the offset index."""
+        return self._maintain_offsets
+
+    @property
+    def indexes(self) -> Dict[str, FieldIndex]:
+        """Returns the secondary indexes of the document, by field."""
+        return self._indexes
+
+    def index_stats(self) -> Dict[str, Dict[str, float]]:
+        """Values, entries, bytes on disk, memory and build seconds
+        of each secondary index.
+        """
+        stats = {}
+        for field, index in self.indexes.items():
+            index.sync()
+            stats[field] = index.stats()
+            logging.info(f"MessageDocument index {field:s}: {str(stats[field]):s}")
+        return stats
+
     def start(self) -> None:
         """Placeholder for operations to perform before using self.messages()."""
         pass
 
     def messages(self) -> Generator[Dict[str, str], None, None]:
         """Yields messages from the store file."""
-        with open(self.resource, "r", encoding="utf-8") as origin:
-            for line in origin:
-                message = json.loads(line)
-                yield {str(k): str(v) for k, v in message.items()}
+        loads = self.codec.loads
+        for line in read_lines(self.resource):
+            yield stringify(loads(line))
+
+    def raw_messages(self) -> Generator[Dict[str, Any], None, None]:
+        """Yields messages as decoded, values keep their json types."""
+        loads = self.codec.loads
+        for line in read_lines(self.resource):
+            yield loads(line)
 
     def stop(self) -> None:
         """Placeholder for operations to perform after using self.messages()."""
         pass
 
     def where(
-        self, select: Callable[[Dict[str, str]], bool]
+        self,
+        select: Callable[[Dict[str, str]], bool],
+        workers: int = 1,
+        ordered: bool = True,
     ) -> Generator[Dict[str, str], None, None]:
+        """Yields the messages accepted by select.
+        workers: scan byte ranges of the file in that many processes,
+            select must then be picklable (a Filter, or a module level
+            function, not a lambda)
+        ordered: with workers, yield in file order, or as ranges finish
+        A Filter over indexed fields is answered from the indexes.
+        """
         self.start()
-        for this_message in self.messages():
-            if select(this_message):
-                yield this_message
+        offsets = None
+        if isinstance(select, Filter) and self.indexes:
+            for index in self.indexes.values():
+                index.sync()
+            offsets = plan(select, self.indexes)
+        if offsets is not None:
+            yield from self.read_at(offsets, select)
+        elif workers > 1:
+            yield from self.scan(select, workers, ordered)
+        else:
+            for this_message in self.messages():
+                if select(this_message):
+                    yield this_message
         self.stop()
 
+    def read_at(
+        self, offsets: Iterable[int], select: Callable[[Dict[str, str]], bool]
+    ) -> Generator[Dict[str, str], None, None]:
+        """Yields the messages starting at offsets accepted by select."""
+        loads = self.codec.loads
+        with open(self.resource, "rb") as origin:
+            for offset in offsets:
+                origin.seek(offset)
+                message = stringify(loads(origin.readline().rstrip(b"\n")))
+                if select(message):
+                    yield message
+
+    def scan(
+        self,
+        select: Callable[[Dict[str, str]], bool],
+        workers: int,
+        ordered: bool = True,
+        part: int = PART,
+    ) -> Generator[Dict[str, str], None, None]:
+        """Parallel where: the file is cut in parts of about part bytes,
+        each one scanned by a process, at most 2 * workers at once.
+        """
+        ranges = get_ranges(self.resource, part)
+        with ProcessPoolExecutor(workers) as executor:
+            pending: Deque[Future] = deque()
+            for start, stop in ranges:
+                pending.append(
+                    executor.submit(
+                        _scan, self.resource, self.codec.name, start, stop, select
+                    )
+                )
+                if len(pending) >= 2 * workers:
+                    yield from _finished(pending, ordered)
+            while pending:
+                yield from _finished(pending, ordered)
+
     def update(self, origin: MessageGenerator) -> None:
         """Appends messages to the document file."""
         origin.start()
-        with open(self.resource, "a", encoding="utf-8") as target:
+        with self.open_writer() as writer:
             for message in origin.messages():
-                line = json.dumps(message)
-                target.write(f"{line}\n")
+                writer.write(message)
         origin.stop()
+
+    @contextmanager
+    def open_writer(
+        self,
+        batch: int = 1024,
+        fsync_every: int = 0,
+        fsync_interval: float = 0.0,
+        linger: float = LINGER,
+    ) -> Generator["MessageWriter", None, None]:
+        """A MessageWriter for a long-lived producer, closed on exit.
+        See MessageWriter for the arguments.
+        """
+        writer = MessageWriter(self, batch, fsync_every, fsync_interval, linger)
+        try:
+            yield writer
+        finally:
+            writer.close()
+
+    def repair(self) -> int:
+        """Truncates a torn last line, left by a crash while appending.
+        A last line that only lacks its newline, but decodes to a
+        message, is kept and the newline appended.
+        Returns how many bytes were dropped.
+        """
+        if not self.resource.exists():
+            return 0
+        size = os.path.getsize(self.resource)
+        with open(self.resource, "rb+") as target:
+            end = size
+            while end > 0:
+                start = max(0, end - CHUNK)
+                target.seek(start)
+                block = target.read(end - start)
+                newline = block.rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                target.seek(end)
+                tail = target.read(size - end)
+                if self.complete(tail):
+                    target.seek(size)
+                    target.write(b"\n")
+                    return 0
+                target.truncate(end)
+        if end < size:
+            logging.warning(
+                f"MessageDocument.repair: {str(self.resource):s} "
+                f"torn tail of {size - end:d} bytes dropped"
+            )
+            self.offsets.truncate(end)
+        return size - end
+
+    def complete(self, line: bytes) -> bool:
+        """True if line, without its newline, decodes to a message."""
+        if not line.strip():
+            return False
+        try:
+            return isinstance(self.codec.loads(line), dict)
+        except Exception:
+            return False
+
+    def rebuild_offsets(self) -> None:
+        """Indexes an existing messages.jsonl from scratch."""
+        self.offsets.rebuild()
+
+    def count(self) -> int:
+        """Number of messages, from the offset index."""
+        self.offsets.sync()
+        return self.offsets.count()
+
+    def slice(self, start: int, stop: int) -> List[Dict[str, str]]:
+        """Messages start to stop - 1, read through the offset index.
+        Negative positions count from the end, as in a list.
+        """
+        self.offsets.sync()
+        count = self.offsets.count()
+        start, stop, _ = slice(start, stop).indices(count)
+        loads = self.codec.loads
+        return [stringify(loads(line)) for line in self.offsets.read(start, stop)]
+
+    def get(self, n: int) -> Dict[str, str]:
+        """Message n, read through the offset index."""
+        self.offsets.sync()
+        count = self.offsets.count()
+        if not -count <= n < count:
+            raise IndexError(f"MessageDocument.get: {n:d} out of range ({count:d})")
+        if n < 0:
+            n += count
+        return self.slice(n, n + 1)[0]
+
+    def tail(self, k: int) -> List[Dict[str, str]]:
+        """The last k messages."""
+        return self.slice(-k, self.count()) if k > 0 else []
+
+
+class MessageWriter:
+    """Appends messages to a MessageDocument in batches.
+    Messages are encoded as they come, and written with one call per
+    batch through a large buffer. The offset and field indexes of the
+    document are extended once per batch.
+    Durability: the file is fsynced every fsync_every messages and/or
+    every fsync_interval seconds, never if both are 0. The indexes are
+    not fsynced, they catch up with the document when they lag.
+    A torn last line, left by a crash, is truncated on open.
+    An idle producer doesn't hold messages back: a timer commits a
+    batch linger seconds after its first message, and syncs when
+    fsync_interval says so. linger 0 waits for a full batch.
+    Writes may come from several threads.
+    """
+
+    def __init__(
+        self,
+        document: MessageDocument,
+        batch: int = 1024,
+        fsync_every: int = 0,
+        fsync_interval: float = 0.0,
+        linger: float = LINGER,
+    ) -> None:
+        self._document = document
+        self._batch = max(batch, 1)
+        self._fsync_every = fsync_every
+        self._fsync_interval = fsync_interval
+        self._linger = linger
+        self._dumps = document.codec.dumps
+        document.repair()
+        if document.maintain_offsets:
+            document.offsets.sync()
+        for index in document.indexes.values():
+            index.sync()
+        self._target = open(document.resource, "ab", buffering=BUFFER)
+        self._position = self._target.tell()
+        self._lines: List[bytes] = []
+        self._messages: List[Dict[str, Any]] = []
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        self._lock = threading.RLock()
+        self._timer: Optional[threading.Timer] = None
+
+    @property
+    def document(self) -> MessageDocument:
+        return self._document
+
+    def write(self, message: Dict[str, Any]) -> None:
+        line = self._dumps(message) + b"\n"
+        with self._lock:
+            self._lines.append(line)
+            self._messages.append(message)
+            if len(self._lines) >= self._batch or self.due():
+                self.commit()
+            # a slow producer never fills a batch, the timer commits it
+            self.schedule()
+
+    def schedule(self) -> None:
+        """Starts the timer, unless running, if messages are waiting:
+        in the batch for linger seconds, to be synced for what is left
+        of fsync_interval.
+        """
+        if self._timer is not None or not self._linger:
+            return
+        delays = []
+        if self._lines:
+            delays.append(self._linger)
+        if self._fsync_interval and (self._lines or self._unsynced):
+            elapsed = time.monotonic() - self._synced_at
+            delays.append(max(self._fsync_interval - elapsed, 0.0))
+        if not delays:
+            return
+        self._timer = threading.Timer(min(delays), self.expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def expire(self) -> None:
+        with self._lock:
+            self._timer = None
+            if self._target.closed:
+                return
+            self.commit()
+            if self.due():
+                self.sync()
+            self.schedule()
+
+    def write_many(self, messages: Iterable[Dict[str, Any]]) -> None:
+        for message in messages:
+            self.write(message)
+
+    def commit(self) -> None:
+        """Writes the pending batch, and fsyncs if the policy says so."""
+        with self._lock:
+            if not self._lines:
+                return
+            document = self._document
+            starts = array("Q")
+            values: Dict[str, Dict[str, List[int]]] = {f: {} for f in document.indexes}
+            start = position = self._position
+            for line, message in zip(self._lines, self._messages):
+                starts.append(position)
+                for field, table in values.items():
+                    if field in message:
+                        # as stringify() renders it, null too
+                        table.setdefault(str(message[field]), []).append(position)
+                position += len(line)
+            self._target.write(b"".join(self._lines))
+            self._unsynced += len(self._lines)
+            self._position = position
+            self._lines, self._messages = [], []
+            if self.due():
+                self.sync()
+            else:
+                self._target.flush()
+            if document.maintain_offsets:
+                document.offsets.append(starts)
+            for field, index in document.indexes.items():
+                index.append(values[field], start, position)
+
+    def due(self) -> bool:
+        """True when the fsync policy asks to sync the messages
+        written, committed or not, since the last sync.
+        """
+        pending = self._unsynced + len(self._lines)
+        if not pending:
+            return False
+        if self._fsync_every and pending >= self._fsync_every:
+            return True
+        if self._fsync_interval:
+            return time.monotonic() - self._synced_at >= self._fsync_interval
+        return False
+
+    def sync(self) -> None:
+        self._target.flush()
+        os.fsync(self._target.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def flush(self) -> None:
+        """Commits the pending batch and fsyncs, whatever the policy."""
+        with self._lock:
+            self.commit()
+            if self._unsynced:
+                self.sync()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._target.closed:
+                return
+            self.commit()
+            if self._fsync_every or self._fsync_interval:
+                self.sync()
+            self._target.close()
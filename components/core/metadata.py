@@ -1,20 +1,69 @@
 from collections import Counter, defaultdict
 import datetime
 import json
+import os
 from pathlib import Path
-from typing import DefaultDict, Dict, Tuple, Generator
+from typing import IO, DefaultDict, Dict, Tuple, Generator, Optional
 
-from components.helpers import write_json, get_directory, get_timestamp, get_resource
+from components.helpers import get_directory, get_timestamp, get_resource, classname
+
+from components.core.database import BATCH, MetadataDatabase
+
+
+# log records that trigger a compaction into store.json
+COMPACT = 1 << 12
+
+ENGINES = ("log", "sqlite")
+
+
+class MetadataError(Exception):
+    pass
 
 
 class Metadata:
-    def __init__(self, directory: Path) -> None:
+    """records identifier -> attribute -> value.
+    store.json is a snapshot, a json record per line; add_item appends
+    the change to store.log. Every compact log records, the snapshot is
+    rewritten and the log emptied. Loading reads the snapshot, then
+    replays the log.
+    With engine "sqlite", records are rows of store.sqlite instead,
+    see MetadataDatabase: nothing is loaded in memory, several processes
+    may share the store, and identifiers() and changed_since() are
+    answered from indexes.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        compact: int = COMPACT,
+        engine: str = "log",
+        batch: int = BATCH,
+    ) -> None:
+        """
+        compact: log records that trigger a compaction, engine "log"
+        engine: "log" or "sqlite"
+        batch: rows written in a transaction, engine "sqlite"
+        """
+        if engine not in ENGINES:
+            raise MetadataError(f"{classname(self):s}: unknown engine {engine:s}")
         self._directory: Path = get_directory(directory)
         self._store: Path = get_resource(self.directory, "store", ".json")
+        self._log: Path = get_resource(self.directory, "store", ".log")
+        self._compact: int = compact
+        self._changes: int = 0
+        self._target: Optional[IO[str]] = None
         self._records: DefaultDict[str, DefaultDict[str, Dict[str, str]]] = defaultdict(
             lambda: defaultdict(dict)
         )
-        if self.store.exists():
+        self._database: Optional[MetadataDatabase] = None
+        if engine == "sqlite":
+            self._database = MetadataDatabase(
+                get_resource(self.directory, "store", ".sqlite"), batch
+            )
+            if self._database.get(".", "creation") is None:
+                self.add_item(".", "creation", {"timestamp": get_timestamp()})
+                self._database.flush()
+        elif self.store.exists():
             self.read_records()
         else:
             self.create_records()
@@ -27,24 +76,61 @@ class Metadata:
     def store(self) -> Path:
         return self._store
 
+    @property
+    def log(self) -> Path:
+        return self._log
+
+    @property
+    def engine(self) -> str:
+        return "log" if self._database is None else "sqlite"
+
     @property
     def records(self) -> DefaultDict[str, DefaultDict[str, Dict[str, str]]]:
-        return self._records
+        """With engine "sqlite", a copy of the whole table; prefer items()."""
+        if self._database is None:
+            return self._records
+        records: DefaultDict[str, DefaultDict[str, Dict[str, str]]] = defaultdict(
+            lambda: defaultdict(dict)
+        )
+        for identifier, attribute, value in self._database.items():
+            records[identifier][attribute] = value
+        return records
 
     def create_records(self) -> None:
-        self.add_item(".", "creation", {"timestamp": get_timestamp()})
-        write_json(self.store, self.records)
+        self.set_item(".", "creation", {"timestamp": get_timestamp()})
+        self.write_records()
 
     def read_records(self) -> None:
         with open(self.store, "r", encoding="utf-8") as source:
             for line in source:
                 record = json.loads(line)
-                self.add_item(
-                    record["identifier"], record["attribute"], record["value"]
-                )
+                if "identifier" not in record:
+                    # a store written as a single json object
+                    for identifier, table in record.items():
+                        for attribute, value in table.items():
+                            self.set_item(identifier, attribute, value)
+                    continue
+                self.set_item(record["identifier"], record["attribute"], record["value"])
+        if not self.log.exists():
+            return
+        valid = 0
+        with open(self.log, "rb") as source:
+            for line in source:
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                self.set_item(record["identifier"], record["attribute"], record["value"])
+                self._changes += 1
+                valid += len(line)
+        if valid < self.log.stat().st_size:
+            # a record torn by a crash, cut before appending after it
+            os.truncate(self.log, valid)
 
     def write_records(self) -> None:
-        with open(self.store, "w", encoding="utf-8") as target:
+        """Writes the snapshot, then empties the log."""
+        self.close_log()
+        scratch = self.store.with_suffix(".tmp")
+        with open(scratch, "w", encoding="utf-8") as target:
             for identifier, attribute, value in self.items():
                 record = {
                     "identifier": identifier,
@@ -52,17 +138,74 @@ class Metadata:
                     "value": value,
                 }
                 target.write(f"{json.dumps(record):s}\n")
+        os.replace(scratch, self.store)
+        # replaying a log over the snapshot holding it changes nothing,
+        # so a crash before this point loses nothing
+        if self.log.exists():
+            self.log.unlink()
+        self._changes = 0
+
+    def close_log(self) -> None:
+        if self._target is not None:
+            self._target.close()
+            self._target = None
 
     def start(self) -> None:
         pass
 
     def stop(self) -> None:
-        self.write_records()
+        """Closes the log, the snapshot is only rewritten at compaction.
+        With engine "sqlite", commits the pending rows.
+        """
+        if self._database is not None:
+            self._database.flush()
+        self.close_log()
 
     def items(self) -> Generator[Tuple[str, str, Dict], None, None]:
+        if self._database is not None:
+            yield from self._database.items()
+            return
         for identifier, table in self.records.items():
             for attribute, value in table.items():
                 yield identifier, attribute, value
 
-    def add_item(self, identifier: str, attribute: str, value: Dict) -> None:
+    def set_item(self, identifier: str, attribute: str, value: Dict) -> None:
         self.records[identifier][attribute] = value
+
+    def get_item(self, identifier: str, attribute: str) -> Optional[Dict]:
+        if self._database is not None:
+            return self._database.get(identifier, attribute)
+        return self._records.get(identifier, {}).get(attribute)
+
+    def identifiers(self, attribute: str) -> Generator[str, None, None]:
+        """The identifiers with a value for attribute."""
+        if self._database is not None:
+            yield from self._database.identifiers(attribute)
+            return
+        for identifier, table in self._records.items():
+            if attribute in table:
+                yield identifier
+
+    def changed_since(
+        self, timestamp: str
+    ) -> Generator[Tuple[str, str, Dict, str], None, None]:
+        """(identifier, attribute, value, changed) of the records changed
+        at or after timestamp, a get_timestamp() string. Engine "sqlite".
+        """
+        if self._database is None:
+            raise MetadataError(f"{classname(self):s}.changed_since: needs engine sqlite")
+        yield from self._database.changed_since(timestamp)
+
+    def add_item(self, identifier: str, attribute: str, value: Dict) -> None:
+        if self._database is not None:
+            self._database.put(identifier, attribute, value)
+            return
+        self.set_item(identifier, attribute, value)
+        if self._target is None:
+            self._target = open(self.log, "a", encoding="utf-8")
+        record = {"identifier": identifier, "attribute": attribute, "value": value}
+        self._target.write(f"{json.dumps(record):s}\n")
+        self._target.flush()
+        self._changes += 1
+        if self._changes >= self._compact:
+            self.write_records()
@@ -0,0 +1,170 @@
+from array import array
+from contextlib import contextmanager
+import fcntl
+import os
+from pathlib import Path
+from typing import Iterable, Iterator, Tuple
+
+from components.core.codecs import CHUNK
+
+
+@contextmanager
+def locked(lock: Path) -> Iterator[None]:
+    """An exclusive fcntl lock on the file lock, for the processes
+    extending the same sidecar.
+    """
+    with open(lock, "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+class OffsetIndex:
+    """Sidecar of a jsonl document: the byte offset where each
+    non empty line starts, as unsigned 64 bit integers.
+    Line n starts at offset 8 * n of the sidecar.
+    Readers and writers of the document, in any process, extend it
+    under an fcntl lock on the .lock file next to it.
+    """
+
+    def __init__(self, resource: Path, document: Path) -> None:
+        self._resource: Path = resource
+        self._document: Path = document
+        self._lock: Path = resource.with_suffix(".lock")
+
+    @property
+    def resource(self) -> Path:
+        return self._resource
+
+    @property
+    def document(self) -> Path:
+        return self._document
+
+    @property
+    def lock(self) -> Path:
+        return self._lock
+
+    def count(self) -> int:
+        if not self.resource.exists():
+            return 0
+        return os.path.getsize(self.resource) // 8
+
+    def offsets(self, start: int, stop: int) -> array:
+        """Offsets of lines start to stop - 1."""
+        values = array("Q")
+        if stop <= start:
+            return values
+        with open(self.resource, "rb") as source:
+            source.seek(8 * start)
+            values.frombytes(source.read(8 * (stop - start)))
+        return values
+
+    def offset(self, n: int) -> int:
+        return self.offsets(n, n + 1)[0]
+
+    def append(self, values: Iterable[int]) -> None:
+        """Adds the offsets of lines just written to the document,
+        those a sync didn't index already. When they don't start
+        where the index ends, the document is indexed from there.
+        """
+        with locked(self.lock):
+            start = self.end()
+            if start < 0:
+                self.index()
+                return
+            values = array("Q", (value for value in values if value >= start))
+            if values and values[0] != start:
+                values = self.scan(start)
+            self.write(values)
+
+    def write(self, values: array) -> None:
+        with open(self.resource, "ab") as target:
+            target.write(values.tobytes())
+
+    def end(self) -> int:
+        """Where the line after the last indexed one starts."""
+        count = self.count()
+        if count == 0:
+            return 0
+        last = self.offset(count - 1)
+        if last >= os.path.getsize(self.document):
+            # the document is shorter than the index says
+            return -1
+        with open(self.document, "rb") as source:
+            source.seek(last)
+            line = source.readline()
+        return last + len(line)
+
+    def sync(self) -> None:
+        """Indexes the lines appended since the last sync,
+        rebuilding the whole index when it doesn't fit the document.
+        """
+        with locked(self.lock):
+            self.index()
+
+    def index(self) -> None:
+        """sync, the lock held."""
+        if not self.document.exists():
+            if self.count():
+                self.resource.unlink()
+            return
+        start = self.end()
+        if start < 0 or start > os.path.getsize(self.document):
+            self.resource.unlink()
+            start = 0
+        self.write(self.scan(start))
+
+    def truncate(self, size: int) -> None:
+        """Drops the lines starting at or after size,
+        once the document was cut to size bytes.
+        """
+        with locked(self.lock):
+            count = self.count()
+            while count and self.offset(count - 1) >= size:
+                count -= 1
+            if self.resource.exists():
+                os.truncate(self.resource, 8 * count)
+
+    def rebuild(self) -> None:
+        with locked(self.lock):
+            if self.resource.exists():
+                self.resource.unlink()
+            self.index()
+
+    def scan(self, position: int) -> array:
+        """Offsets of the non empty lines from position on. A last
+        line without its newline may still be being written, it is
+        left for a later sync.
+        """
+        values = array("Q")
+        with open(self.document, "rb") as source:
+            source.seek(position)
+            rest = b""
+            while True:
+                block = source.read(CHUNK)
+                if not block:
+                    break
+                lines = (rest + block).split(b"\n")
+                rest = lines.pop()
+                for line in lines:
+                    if line:
+                        values.append(position)
+                    position += len(line) + 1
+        return values
+
+    def read(self, start: int, stop: int) -> Tuple[bytes, ...]:
+        """Lines start to stop - 1, without newlines."""
+        count = self.count()
+        start, stop = max(start, 0), min(stop, count)
+        if stop <= start:
+            return ()
+        begin = self.offset(start)
+        with open(self.document, "rb") as source:
+            source.seek(begin)
+            if stop < count:
+                block = source.read(self.offset(stop) - begin)
+            else:
+                block = source.read()
+        return tuple(line for line in block.split(b"\n") if line)[: stop - start]
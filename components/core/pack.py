@@ -0,0 +1,241 @@
+import io
+import json
+import mmap
+import os
+from pathlib import Path
+from shutil import copyfileobj
+from collections import OrderedDict
+from typing import Any, Dict, List, Generator, Optional, Union, IO
+
+from components.helpers import classname
+
+
+class PackError(Exception):
+    pass
+
+
+# a pack stores the files of the sample directories of a leaf directory:
+#     samples/AAA/BBB.pack       the bytes of every file, one after another
+#     samples/AAA/BBB.pack.json  {sample name: {file name: [offset, size]}}
+
+
+def get_pack(leaf: Path) -> Path:
+    return leaf.with_name(f"{leaf.name:s}.pack")
+
+
+def get_pack_index(leaf: Path) -> Path:
+    return leaf.with_name(f"{leaf.name:s}.pack.json")
+
+
+def write_pack(leaf: Path) -> Path:
+    """Copy the sample directories of leaf into a pack.
+    Both files are written aside and renamed into place,
+    so readers never see a partial pack. The caller removes leaf.
+    Raises PackError, writing nothing, if leaf holds anything a pack
+    can't: a sample with a subdirectory, a link, or a file beside
+    the samples.
+    """
+    pack, pack_index = get_pack(leaf), get_pack_index(leaf)
+    for sample in leaf.iterdir():
+        if sample.is_symlink() or not sample.is_dir():
+            raise PackError(f"write_pack: {str(sample):s} is not a sample directory")
+        for item in sample.iterdir():
+            if item.is_symlink() or not item.is_file():
+                raise PackError(f"write_pack: {str(item):s} is not a plain file")
+    offsets: Dict[str, Dict[str, List[int]]] = {}
+    scratch = pack.with_name(f"{pack.name:s}.tmp")
+    with open(scratch, "wb") as target:
+        for sample in sorted(leaf.iterdir()):
+            files = offsets.setdefault(sample.name, {})
+            for item in sorted(sample.iterdir()):
+                offset = target.tell()
+                with open(item, "rb") as source:
+                    copyfileobj(source, target)
+                files[item.name] = [offset, target.tell() - offset]
+        target.flush()
+        os.fsync(target.fileno())
+    index_scratch = pack_index.with_name(f"{pack_index.name:s}.tmp")
+    with open(index_scratch, "w", encoding="utf-8") as target:
+        json.dump(offsets, target)
+    os.replace(scratch, pack)
+    os.replace(index_scratch, pack_index)
+    return pack
+
+
+def check_pack(leaf: Path) -> None:
+    """Raises PackError unless the pack of leaf holds every file
+    of leaf, with its size, and nothing else is in leaf.
+    """
+    reader = PackReader(leaf)
+    try:
+        packed = {
+            (sample, name): size
+            for sample, files in reader.offsets.items()
+            for name, (_, size) in files.items()
+        }
+        if set(reader.offsets) != {sample.name for sample in leaf.iterdir()}:
+            raise PackError(f"check_pack: samples of {str(leaf):s} differ")
+        found = {}
+        for sample in leaf.iterdir():
+            for item in sample.iterdir():
+                if item.is_symlink() or not item.is_file():
+                    raise PackError(f"check_pack: {str(item):s} is not packed")
+                found[(sample.name, item.name)] = item.stat().st_size
+        if found != packed:
+            raise PackError(f"check_pack: files of {str(leaf):s} differ")
+    finally:
+        reader.close()
+
+
+# readers opened to unpickle samples sent to another process
+_readers: "OrderedDict[Path, PackReader]" = OrderedDict()
+READERS = 64
+
+
+def _open_sample(leaf: Path, name: str) -> "PackedSample":
+    try:
+        _readers.move_to_end(leaf)
+    except KeyError:
+        _readers[leaf] = PackReader(leaf)
+        if len(_readers) > READERS:
+            _, reader = _readers.popitem(last=False)
+            reader.close()
+    return _readers[leaf].sample(name)
+
+
+class PackReader:
+    """Memory-mapped, read only view of a pack."""
+
+    def __init__(self, leaf: Path) -> None:
+        self._leaf: Path = leaf
+        with open(get_pack_index(leaf), "r", encoding="utf-8") as source:
+            self._offsets: Dict[str, Dict[str, List[int]]] = json.load(source)
+        self._handle = open(get_pack(leaf), "rb")
+        if os.fstat(self._handle.fileno()).st_size:
+            self._buffer: Union[mmap.mmap, bytes] = mmap.mmap(
+                self._handle.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        else:
+            # mmap refuses empty files
+            self._buffer = b""
+
+    @property
+    def leaf(self) -> Path:
+        return self._leaf
+
+    @property
+    def offsets(self) -> Dict[str, Dict[str, List[int]]]:
+        return self._offsets
+
+    def view(self, sample: str, name: str) -> memoryview:
+        offset, size = self.offsets[sample][name]
+        return memoryview(self._buffer)[offset : offset + size]
+
+    def sample(self, name: str) -> "PackedSample":
+        return PackedSample(self, name)
+
+    def close(self) -> None:
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._handle.close()
+
+
+class PackedFile:
+    """The part of pathlib.Path used to read a file of a sample."""
+
+    def __init__(self, reader: PackReader, sample: str, name: str) -> None:
+        self._reader = reader
+        self._sample = sample
+        self._name = name
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def suffix(self) -> str:
+        return Path(self.name).suffix
+
+    @property
+    def stem(self) -> str:
+        return Path(self.name).stem
+
+    @property
+    def parent(self) -> "PackedSample":
+        return PackedSample(self._reader, self._sample)
+
+    def __str__(self) -> str:
+        return str(Path(self._reader.leaf, self._sample, self.name))
+
+    def exists(self) -> bool:
+        return self.name in self._reader.offsets.get(self._sample, {})
+
+    def is_file(self) -> bool:
+        return self.exists()
+
+    def is_dir(self) -> bool:
+        return False
+
+    def size(self) -> int:
+        return self._reader.offsets[self._sample][self.name][1]
+
+    def read_bytes(self) -> bytes:
+        return bytes(self._reader.view(self._sample, self.name))
+
+    def read_text(self, encoding: Optional[str] = "utf-8") -> str:
+        return self.read_bytes().decode(encoding or "utf-8")
+
+    def open(self, mode: str = "r", encoding: Optional[str] = "utf-8") -> IO:
+        if "w" in mode or "a" in mode or "+" in mode:
+            raise PermissionError(f"{classname(self):s}.open: {str(self):s} is read only")
+        binary = io.BytesIO(self._reader.view(self._sample, self.name))
+        if "b" in mode:
+            return binary
+        return io.TextIOWrapper(binary, encoding=encoding)
+
+
+class PackedSample:
+    """The part of pathlib.Path used to walk a sample directory."""
+
+    def __init__(self, reader: PackReader, name: str) -> None:
+        self._reader = reader
+        self._name = name
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def parent(self) -> Path:
+        return self._reader.leaf
+
+    def __str__(self) -> str:
+        return str(Path(self._reader.leaf, self.name))
+
+    def __reduce__(self) -> Any:
+        # the mmap can't be pickled, the other side opens its own reader
+        return _open_sample, (self._reader.leaf, self.name)
+
+    def __truediv__(self, name: str) -> PackedFile:
+        return PackedFile(self._reader, self.name, name)
+
+    def joinpath(self, name: str) -> PackedFile:
+        return self / name
+
+    def exists(self) -> bool:
+        return self.name in self._reader.offsets
+
+    def is_dir(self) -> bool:
+        return self.exists()
+
+    def is_file(self) -> bool:
+        return False
+
+    def iterdir(self) -> Generator[PackedFile, None, None]:
+        for name in self._reader.offsets.get(self.name, {}):
+            yield PackedFile(self._reader, self.name, name)
+
+    def glob(self, pattern: str) -> Generator[PackedFile, None, None]:
+        for item in self.iterdir():
+            if Path(item.name).match(pattern):
+                yield item
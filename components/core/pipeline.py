@@ -0,0 +1,413 @@
+import copy
+from itertools import islice
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple
+
+from components.core.store import Store, SampleTask, SampleTaskPipeline
+from components.helpers import classname, get_directory, get_resource
+
+
+class SampleTaskRunnerError(Exception):
+    pass
+
+
+# seconds waited for a report before checking the workers are alive
+POLL = 1.0
+
+
+def _chunks(samples: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    iterator = iter(samples)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _downstream(tasks: List[SampleTask], requirements: Dict[str, Set[str]]) -> List[Set[int]]:
+    """For each task position, itself and the positions of every task
+    depending on it, directly or not. tasks is in pipeline order.
+    """
+    positions = {task.identifier: position for position, task in enumerate(tasks)}
+    downstream = [{position} for position in range(len(tasks))]
+    # dependents come later in the order, so walk it backwards
+    for position in reversed(range(len(tasks))):
+        for required in requirements[tasks[position].identifier]:
+            downstream[positions[required]] |= downstream[position]
+    return downstream
+
+
+def _work(
+    pipeline: SampleTaskPipeline, target: Path, chunks: Any, done: Any
+) -> None:
+    """Worker loop: start the tasks once, execute them over every
+    chunk taken from chunks until None, stop them once.
+    A chunk holds (sample_home, key, pending) items: the tasks at the
+    positions in pending, or every task if None, are executed on
+    sample_home in pipeline order. When a task fails, the tasks
+    depending on it are skipped for that sample, the others still run.
+    Reports (processed, failed, reached, seconds) per chunk to done,
+    then None. reached lists (key, pending, completed positions)
+    for every sample, seconds is the time spent in each task.
+    """
+    tasks = pipeline.order()
+    downstream = _downstream(tasks, pipeline.requirements())
+    everything = tuple(range(len(tasks)))
+    try:
+        for task in tasks:
+            task.start()
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            failed = 0
+            reached: List[Tuple[str, Any, Tuple[int, ...]]] = []
+            seconds = [0.0] * len(tasks)
+            for sample_home, key, pending in chunk:
+                blocked: Set[int] = set()
+                completed: List[int] = []
+                for position in everything if pending is None else pending:
+                    if position in blocked:
+                        continue
+                    task = tasks[position]
+                    start_time = time.perf_counter()
+                    try:
+                        task.sample_home = sample_home
+                        task.execute()
+                        completed.append(position)
+                    except Exception as message:
+                        blocked |= downstream[position]
+                        logging.error(
+                            f"SampleTaskRunner: {task.identifier:s} failed "
+                            f"on {str(sample_home):s}: {str(message):s}"
+                        )
+                    seconds[position] += time.perf_counter() - start_time
+                if blocked:
+                    failed += 1
+                reached.append((key, pending, tuple(completed)))
+            done.put((len(chunk), failed, reached, seconds))
+        for task in tasks:
+            task.stop(target)
+    finally:
+        done.put(None)
+
+
+class Checkpoint:
+    """Which samples a task has completed, one file per task:
+        checkpoints/<task identifier>.txt
+    The first line is the task version, then one line per event,
+    +key when the sample completed, -key when it was invalidated.
+    A new task version starts the file again, so every sample
+    is processed once more.
+    """
+
+    def __init__(self, directory: Path, identifier: str, version: str) -> None:
+        self._resource: Path = get_resource(directory, identifier, ".txt")
+        self._version: str = version
+        self._completed: Set[str] = set()
+        if self.resource.exists():
+            self.read()
+        else:
+            self.write()
+        self._target: Optional[IO[str]] = None
+
+    @property
+    def resource(self) -> Path:
+        return self._resource
+
+    @property
+    def version(self) -> str:
+        return self._version
+
+    def read(self) -> None:
+        with open(self.resource, "r", encoding="utf-8") as source:
+            version = source.readline().rstrip("\n")
+            if version != self.version:
+                logging.info(
+                    f"Checkpoint: {str(self.resource):s} version "
+                    f"{version:s} -> {self.version:s}, samples invalidated"
+                )
+            else:
+                for line in source:
+                    key = line[1:].rstrip("\n")
+                    if line[0] == "+":
+                        self._completed.add(key)
+                    else:
+                        self._completed.discard(key)
+        # rewrite, dropping invalidations and a stale version
+        self.write()
+
+    def write(self) -> None:
+        scratch = self.resource.with_suffix(".tmp")
+        with open(scratch, "w", encoding="utf-8") as target:
+            target.write(f"{self.version:s}\n")
+            for key in self._completed:
+                target.write(f"+{key:s}\n")
+        os.replace(scratch, self.resource)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._completed
+
+    def append(self, line: str) -> None:
+        if self._target is None:
+            self._target = open(self.resource, "a", encoding="utf-8")
+        self._target.write(f"{line:s}\n")
+
+    def complete(self, key: str) -> None:
+        self._completed.add(key)
+        self.append(f"+{key:s}")
+
+    def invalidate(self, key: str) -> None:
+        if key in self._completed:
+            self._completed.discard(key)
+            self.append(f"-{key:s}")
+
+    def close(self) -> None:
+        if self._target is not None:
+            self._target.close()
+            self._target = None
+
+
+class SampleTaskRunner:
+    """Runs a SampleTaskPipeline over the samples of a store.
+    Each worker gets its own copy of the pipeline, starts its tasks
+    once, executes them over chunks of samples and stops them once.
+    At most in_flight chunks are queued, so memory stays bounded
+    however large the store is.
+    """
+
+    def __init__(
+        self,
+        pipeline: SampleTaskPipeline,
+        workers: int = 0,
+        mode: str = "process",
+        chunk_size: int = 64,
+        in_flight: int = 0,
+        incremental: bool = False,
+    ) -> None:
+        """
+        workers: how many workers, os.cpu_count() if 0
+        mode: "process" for CPU bound tasks, "thread" for I/O bound ones
+        chunk_size: samples sent to a worker at once
+        in_flight: chunks queued at once, 2 * workers if 0
+        incremental: keep a Checkpoint per task under store.home,
+            and skip the samples every task already completed
+        """
+        if mode not in ("process", "thread"):
+            raise SampleTaskRunnerError(f"{classname(self):s}: bad mode {mode:s}")
+        self._pipeline = pipeline
+        self._workers = workers or os.cpu_count() or 1
+        self._mode = mode
+        self._chunk_size = chunk_size
+        self._in_flight = in_flight or 2 * self._workers
+        self._incremental = incremental
+
+    @property
+    def pipeline(self) -> SampleTaskPipeline:
+        return self._pipeline
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def mode(self) -> str:
+        return self._mode
+
+    @property
+    def incremental(self) -> bool:
+        return self._incremental
+
+    def checkpoints(self, store: Store) -> List[Checkpoint]:
+        """One Checkpoint per task, in pipeline order."""
+        directory = get_directory(Path(store.home, "checkpoints"))
+        return [
+            Checkpoint(directory, task.identifier, task.version)
+            for task in self.pipeline.order()
+        ]
+
+    def run(self, store: Store, target: Optional[Path] = None) -> Dict[str, Any]:
+        """Executes the pipeline over store.iterate().
+        target is handed to SampleTask.stop, store.home by default.
+        Returns a summary: samples, skipped, failed, seconds,
+        and stages, the seconds spent in each task by all workers.
+        """
+        if not self.incremental:
+            items = ((sample, "", None) for sample in store.iterate())
+            return self.run_items(items, target or store.home, [])
+        checkpoints = self.checkpoints(store)
+        downstream = _downstream(self.pipeline.order(), self.pipeline.requirements())
+        prefix = len(str(store.home)) + 1
+        skipped = [0]
+
+        def pending() -> Iterator[Tuple[Any, str, Tuple[int, ...]]]:
+            for sample in store.iterate():
+                key = str(sample)[prefix:]
+                stale: Set[int] = set()
+                for position, checkpoint in enumerate(checkpoints):
+                    if key not in checkpoint:
+                        # a task runs again, so do those depending on it
+                        stale |= downstream[position]
+                if stale:
+                    yield sample, key, tuple(sorted(stale))
+                else:
+                    skipped[0] += 1
+
+        try:
+            summary = self.run_items(pending(), target or store.home, checkpoints)
+        finally:
+            for checkpoint in checkpoints:
+                checkpoint.close()
+        summary["skipped"] = skipped[0]
+        return summary
+
+    def run_samples(self, samples: Iterable[Any], target: Path) -> Dict[str, Any]:
+        """Executes every task over samples, without checkpoints."""
+        items = ((sample, "", None) for sample in samples)
+        return self.run_items(items, target, [])
+
+    def run_items(
+        self,
+        items: Iterable[Tuple[Any, str, Optional[Tuple[int, ...]]]],
+        target: Path,
+        checkpoints: List[Checkpoint],
+    ) -> Dict[str, Any]:
+        start_time = time.time()
+        tasks = self.pipeline.order()
+        if self.mode == "process":
+            context = multiprocessing.get_context()
+            chunks: Any = context.Queue(self._in_flight)
+            done: Any = context.Queue()
+            workers: List[Any] = [
+                context.Process(
+                    target=_work, args=(self.pipeline, target, chunks, done)
+                )
+                for _ in range(self.workers)
+            ]
+        else:
+            chunks = queue.Queue(self._in_flight)
+            done = queue.Queue()
+            workers = [
+                threading.Thread(
+                    target=_work,
+                    args=(copy.deepcopy(self.pipeline), target, chunks, done),
+                )
+                for _ in range(self.workers)
+            ]
+        for worker in workers:
+            worker.start()
+        counts = [0, 0, 0]  # processed, failed, finished workers
+        seconds = [0.0] * len(tasks)
+        try:
+            for chunk in _chunks(items, self._chunk_size):
+                while True:
+                    self.collect(done, counts, seconds, checkpoints)
+                    if counts[2] == len(workers):
+                        raise SampleTaskRunnerError(
+                            f"{classname(self):s}.run: every worker stopped"
+                        )
+                    if self.lost(workers, done, counts, seconds, checkpoints):
+                        raise SampleTaskRunnerError(
+                            f"{classname(self):s}.run: a worker died"
+                        )
+                    try:
+                        chunks.put(chunk, timeout=1.0)
+                        break
+                    except queue.Full:
+                        continue
+        finally:
+            stops = len(workers) - counts[2]
+            lost = 0
+            while counts[2] + lost < len(workers):
+                if stops:
+                    try:
+                        chunks.put(None, timeout=POLL)
+                        stops -= 1
+                        continue
+                    except queue.Full:
+                        pass
+                self.collect(done, counts, seconds, checkpoints, block=True)
+                lost = self.lost(workers, done, counts, seconds, checkpoints)
+            if lost and self.mode == "process":
+                # nobody reads what is left in chunks
+                chunks.cancel_join_thread()
+            for worker in workers:
+                worker.join()
+        if lost:
+            raise SampleTaskRunnerError(
+                f"{classname(self):s}.run: {lost:d} worker(s) died, "
+                f"their samples are not counted"
+            )
+        summary = {
+            "samples": counts[0],
+            "skipped": 0,
+            "failed": counts[1],
+            "seconds": time.time() - start_time,
+            "stages": {
+                task.identifier: seconds[position]
+                for position, task in enumerate(tasks)
+            },
+        }
+        logging.info(f"{classname(self):s}.run: {str(summary):s}")
+        return summary
+
+    def collect(
+        self,
+        done: Any,
+        counts: List[int],
+        seconds: List[float],
+        checkpoints: List[Checkpoint],
+        block: bool = False,
+    ) -> int:
+        """Adds the reports of the workers to counts, seconds and
+        checkpoints. Waits up to POLL seconds for one report if block,
+        else takes only those available. Returns how many were taken.
+        """
+        taken = 0
+        while True:
+            try:
+                report: Optional[Tuple[int, int, List, List[float]]] = done.get(
+                    block, POLL
+                )
+            except queue.Empty:
+                return taken
+            taken += 1
+            if report is None:
+                counts[2] += 1
+            else:
+                counts[0] += report[0]
+                counts[1] += report[1]
+                for position, spent in enumerate(report[3]):
+                    seconds[position] += spent
+                for key, pending, completed in report[2] if checkpoints else []:
+                    for position in completed:
+                        checkpoints[position].complete(key)
+                    # not run because a task it depends on failed
+                    for position in set(pending) - set(completed):
+                        checkpoints[position].invalidate(key)
+            if block:
+                return taken
+
+    def lost(
+        self,
+        workers: List[Any],
+        done: Any,
+        counts: List[int],
+        seconds: List[float],
+        checkpoints: List[Checkpoint],
+    ) -> int:
+        """How many workers stopped without reporting None: killed,
+        or crashed. The last reports of a worker that stopped may
+        still be on their way, they are collected first.
+        """
+        stopped = sum(not worker.is_alive() for worker in workers)
+        while stopped > counts[2]:
+            if not self.collect(done, counts, seconds, checkpoints, block=True):
+                return stopped - counts[2]
+        return 0
@@ -1,12 +1,27 @@
 from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
 import json
 import os
 from pathlib import Path
-from typing import List, Dict, Protocol, DefaultDict, Any, Callable, Generator
+from typing import List, Dict, Protocol, DefaultDict, Any, Callable, Generator, Optional, Tuple
 
 from components.helpers import get_directory, get_resource, classname
 
-from components.core.messages import MessageDocument
+from components.core.messages import PART, MessageDocument, get_ranges, read_range
+from components.core.codecs import get_codec
+from components.core.sketches import HyperLogLog
+from components.core.columnar import COLUMNAR, ROW_GROUP, write_columns, read_columns
+from components.core.filters import Filter
+from components.core.vectors import (
+    CHUNK_BYTES,
+    add_histogram,
+    column_range,
+    histogram_edges,
+    merge_counts,
+    numpy,
+    read_chunks,
+    read_header,
+)
 from components.core.application import register_error
 
 
@@ -15,18 +30,62 @@ class DictStatsError(Exception):
 
 
 class DictStats:
-    def __init__(self) -> None:
+    """Per key counts of the messages holding it ("total") and of
+    each value type. With profile, also value lengths and a distinct
+    count sketch. Partial stats of parts of a document merge.
+    """
+
+    def __init__(self, profile: bool = False) -> None:
         self._counters: DefaultDict[Any, Counter] = defaultdict(Counter)
+        self._profile: bool = profile
+        self._messages: int = 0
+        self._lengths: Dict[Any, List[int]] = {}
+        self._sketches: Dict[Any, HyperLogLog] = {}
 
     @property
     def counters(self) -> DefaultDict[Any, Counter]:
         return self._counters
 
+    @property
+    def messages(self) -> int:
+        return self._messages
+
     def update(self, message: Dict[Any, Any]) -> None:
+        self._messages += 1
         for key, value in message.items():
             self.counters[key]["total"] += 1
             value_type = type(value).__name__
             self.counters[key][value_type] += 1
+            if self._profile and value is not None:
+                self.measure(key, value if isinstance(value, str) else str(value))
+
+    def measure(self, key: Any, value: str) -> None:
+        length = len(value)
+        try:
+            lengths = self._lengths[key]
+            if length < lengths[0]:
+                lengths[0] = length
+            elif length > lengths[1]:
+                lengths[1] = length
+            self._sketches[key].add(value)
+        except KeyError:
+            self._lengths[key] = [length, length]
+            self._sketches[key] = HyperLogLog()
+            self._sketches[key].add(value)
+
+    def merge(self, other: "DictStats") -> None:
+        """Adds the stats of other, of another part of the document."""
+        self._messages += other.messages
+        for key, count in other.counters.items():
+            self.counters[key].update(count)
+        for key, (low, high) in other._lengths.items():
+            if key in self._lengths:
+                lengths = self._lengths[key]
+                lengths[0], lengths[1] = min(lengths[0], low), max(lengths[1], high)
+                self._sketches[key].merge(other._sketches[key])
+            else:
+                self._lengths[key] = [low, high]
+                self._sketches[key] = other._sketches[key]
 
     def keys(self) -> List[str]:
         p = [count["total"] for key, count in self.counters.items()]
@@ -43,11 +102,61 @@ class DictStats:
             raise DictStatsError(explanation)
         return [str(key) for key in self.counters.keys()]
 
+    def types(self) -> Dict[str, str]:
+        """The type of each key, from the type counts: the one type seen
+        besides None, float when ints and floats are mixed, str otherwise.
+        Unlike keys(), keys missing from some messages are accepted.
+        """
+        types = {}
+        for key, count in self.counters.items():
+            seen = {name for name in count if name not in ("total", "NoneType")}
+            if len(seen) == 1:
+                types[str(key)] = seen.pop()
+            elif seen == {"int", "float"}:
+                types[str(key)] = "float"
+            else:
+                types[str(key)] = "str"
+        return types
+
+    def schema(self) -> Dict[str, Dict[str, Any]]:
+        """The union of the keys of all messages, each with its type
+        and whether it may be null: missing from, or None in, a message.
+        """
+        types = self.types()
+        return {
+            str(key): {
+                "type": types[str(key)],
+                "nullable": count["total"] < self.messages or count["NoneType"] > 0,
+            }
+            for key, count in self.counters.items()
+        }
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        """Per key: presence rate, type histogram, and with profile,
+        estimated distinct values and min/max length of the values.
+        """
+        report = {}
+        for key, count in self.counters.items():
+            entry: Dict[str, Any] = {
+                "presence": count["total"] / self.messages if self.messages else 0.0,
+                "types": {name: n for name, n in count.items() if name != "total"},
+            }
+            if key in self._lengths:
+                entry["distinct"] = self._sketches[key].estimate()
+                entry["min_length"], entry["max_length"] = self._lengths[key]
+            report[str(key)] = entry
+        return report
+
 
 class RowDocument:
-    def __init__(self, directory: Path) -> None:
+    def __init__(self, directory: Path, column_cache: bool = False) -> None:
+        """
+        column_cache: keep the columns loaded by chunks() as .npy files
+            in rows_columns/, so later queries skip parsing rows.csv
+        """
         self._directory: Path = get_directory(directory)
         self._resource: Path = get_resource(self.directory, "rows", ".csv")
+        self._column_cache: bool = column_cache
 
     @property
     def directory(self) -> Path:
@@ -57,6 +166,10 @@ class RowDocument:
     def resource(self) -> Path:
         return self._resource
 
+    @property
+    def column_cache(self) -> bool:
+        return self._column_cache
+
     def start(self) -> None:
         """Placeholder for operations to perform before using self.rows()."""
         pass
@@ -77,14 +190,215 @@ class RowDocument:
                 yield row
         self.stop()
 
-    def write(self, origin: MessageDocument) -> None:
+    def header(self) -> List[str]:
+        return read_header(self.resource)
+
+    def chunks(
+        self,
+        columns: Optional[List[str]] = None,
+        select: Optional[Filter] = None,
+        chunk_bytes: int = CHUNK_BYTES,
+        types: Optional[Dict[str, str]] = None,
+    ) -> Generator[Dict[str, Any], None, None]:
+        """Yields {column: numpy array} for about chunk_bytes of rows.csv
+        at a time, see vectors.read_chunks. With select, a Filter, only
+        the rows it accepts, masked a chunk at a time.
+        """
+        columns = self.header() if columns is None else list(columns)
+        if select is None:
+            yield from read_chunks(
+                self.resource, columns, chunk_bytes, types, self.column_cache
+            )
+            return
+        needed = columns + sorted(select.fields() - set(columns))
+        chunks = read_chunks(self.resource, needed, chunk_bytes, types, self.column_cache)
+        for chunk in chunks:
+            found = select.mask(chunk)
+            yield {column: chunk[column][found] for column in columns}
+
+    def count(self, select: Optional[Filter] = None, chunk_bytes: int = CHUNK_BYTES) -> int:
+        """The number of rows, of rows accepted by select if given."""
+        if select is None:
+            lines = 0
+            with open(self.resource, "rb") as source:
+                while block := source.read(1 << 22):
+                    lines += block.count(b"\n")
+            # without the header
+            return max(lines - 1, 0)
+        found = 0
+        columns = sorted(select.fields())
+        for chunk in read_chunks(
+            self.resource, columns, chunk_bytes, cache=self.column_cache
+        ):
+            found += int(select.mask(chunk).sum())
+        return found
+
+    def sum(
+        self, column: str, select: Optional[Filter] = None, chunk_bytes: int = CHUNK_BYTES
+    ) -> float:
+        """The sum of a numeric column, missing (NaN) values ignored."""
+        total = 0
+        for chunk in self.chunks([column], select, chunk_bytes):
+            total += numpy.nansum(chunk[column]).item()
+        return total
+
+    def histogram(
+        self,
+        column: str,
+        bins: int = 10,
+        range: Optional[Tuple[float, float]] = None,
+        select: Optional[Filter] = None,
+        chunk_bytes: int = CHUNK_BYTES,
+    ) -> Tuple[Any, Any]:
+        """(counts, edges) of a numeric column, as numpy.histogram.
+        Without range, a first pass finds the min and max.
+        """
+        if range is None:
+            range = column_range(self.chunks([column], select, chunk_bytes), column)
+        edges = histogram_edges(bins, *range)
+        counts = add_histogram(None, numpy.array([]), edges)
+        for chunk in self.chunks([column], select, chunk_bytes):
+            counts = add_histogram(counts, chunk[column], edges)
+        return counts, edges
+
+    def value_counts(
+        self, column: str, select: Optional[Filter] = None, chunk_bytes: int = CHUNK_BYTES
+    ) -> Counter:
+        """How many rows hold each value of column."""
+        counts: Counter = Counter()
+        for chunk in self.chunks([column], select, chunk_bytes):
+            merge_counts(counts, chunk[column])
+        return counts
+
+    def write_columnar(
+        self, origin: MessageDocument, form: str = "parquet", row_group: int = ROW_GROUP
+    ) -> Path:
+        """Writes origin as typed columns, to rows.parquet if form is
+        "parquet", or rows.arrow (Arrow IPC, Feather v2) if form is "arrow".
+        Needs pyarrow. Column types come from DictStats over the decoded,
+        not stringified, messages; rows are written row_group at a time.
+        """
+        resource = get_resource(self.directory, "rows", COLUMNAR[form])
         dict_stats = DictStats()
-        for message in origin.messages():
+        for message in origin.raw_messages():
             dict_stats.update(message)
-        keys = dict_stats.keys()
-        header = "|".join([str(k) for k in keys])
-        with open(self.resource, "w", encoding="utf-8") as target:
-            target.write(header + "\n")
-            for message in origin.messages():
-                row = "|".join(str(message[k]) for k in keys)
-                target.write(row + "\n")
+        write_columns(resource, form, dict_stats.types(), origin.raw_messages(), row_group)
+        return resource
+
+    def read_columnar(self, form: str = "parquet", columns: Optional[List[str]] = None) -> Any:
+        """A pyarrow.Table of rows.parquet or rows.arrow, memory-mapped."""
+        resource = get_resource(self.directory, "rows", COLUMNAR[form])
+        return read_columns(resource, form, columns)
+
+    def write(self, origin: MessageDocument, cache: bool = True) -> None:
+        """Writes a row per message, in a single pass over origin.
+        The columns are the keys of the first message; DictStats
+        checks the other messages against them while the rows are
+        written to rows.tmp, which replaces rows.csv at the end.
+        cache: keep the inferred schema in messages.schema.json,
+            and skip inference while messages.jsonl is unchanged.
+        """
+        schema = read_schema(origin) if cache else None
+        dict_stats = DictStats()
+        keys: Optional[List[str]] = None if schema is None else schema["keys"]
+        scratch = self.resource.with_suffix(".tmp")
+        try:
+            with open(scratch, "w", encoding="utf-8") as target:
+                if keys is not None:
+                    target.write("|".join(keys) + "\n")
+                for message in origin.messages():
+                    if schema is None:
+                        dict_stats.update(message)
+                    if keys is None:
+                        keys = [str(k) for k in message.keys()]
+                        target.write("|".join(keys) + "\n")
+                    try:
+                        row = "|".join(str(message[k]) for k in keys)
+                    except KeyError as message_key:
+                        explanation = (
+                            f"{classname(self):s}.write: "
+                            f"bad stats messages (missing {str(message_key):s})."
+                        )
+                        register_error(explanation)
+                        raise DictStatsError(explanation)
+                    target.write(row + "\n")
+                if keys is None:
+                    # no messages
+                    keys = []
+                    target.write("\n")
+            if schema is None:
+                # raises when the messages don't share the same keys
+                dict_stats.keys()
+                if cache:
+                    write_schema(origin, keys, dict_stats)
+        except Exception:
+            scratch.unlink()
+            raise
+        os.replace(scratch, self.resource)
+
+
+def _profile(resource: Path, codec: str, start: int, stop: int) -> DictStats:
+    loads = get_codec(codec).loads
+    dict_stats = DictStats(profile=True)
+    for line in read_range(resource, start, stop):
+        dict_stats.update(loads(line))
+    return dict_stats
+
+
+def profile(origin: MessageDocument, workers: int = 1, part: int = PART) -> DictStats:
+    """DictStats(profile=True) of the decoded messages of origin,
+    merged from parts of about part bytes profiled in workers processes.
+    """
+    dict_stats = DictStats(profile=True)
+    if not origin.resource.exists():
+        return dict_stats
+    ranges = list(get_ranges(origin.resource, part))
+    codec = origin.codec.name
+    if workers > 1 and len(ranges) > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(_profile, origin.resource, codec, start, stop)
+                for start, stop in ranges
+            ]
+            for future in futures:
+                dict_stats.merge(future.result())
+    else:
+        for start, stop in ranges:
+            dict_stats.merge(_profile(origin.resource, codec, start, stop))
+    return dict_stats
+
+
+def get_schema_resource(origin: MessageDocument) -> Path:
+    return Path(origin.directory, "messages.schema.json")
+
+
+def read_schema(origin: MessageDocument) -> Optional[Dict[str, Any]]:
+    """The cached schema of origin, or None if messages.jsonl
+    changed since it was inferred.
+    """
+    resource = get_schema_resource(origin)
+    if not resource.exists() or not origin.resource.exists():
+        return None
+    with open(resource, "r", encoding="utf-8") as source:
+        schema = json.load(source)
+    stat = origin.resource.stat()
+    if schema["size"] != stat.st_size or schema["mtime_ns"] != stat.st_mtime_ns:
+        return None
+    return schema
+
+
+def write_schema(origin: MessageDocument, keys: List[str], dict_stats: DictStats) -> None:
+    if not origin.resource.exists():
+        return
+    stat = origin.resource.stat()
+    schema = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "keys": keys,
+        "counters": {str(k): dict(c) for k, c in dict_stats.counters.items()},
+    }
+    resource = get_schema_resource(origin)
+    scratch = resource.with_suffix(".tmp")
+    with open(scratch, "w", encoding="utf-8") as target:
+        json.dump(schema, target)
+    os.replace(scratch, resource)
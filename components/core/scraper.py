@@ -1,15 +1,56 @@
 import logging
+from collections import Counter
 from contextlib import contextmanager
-from typing import Any, Dict, Generator
+from typing import Any, Dict, Generator, Optional
 
 from requests import Session
 
 from components.helpers import classname, get_timestamp
+from components.core.httpcache import HttpCache, is_fresh
+from components.core.throttle import Throttle
 
 
 class Scraper:
-    def __init__(self) -> None:
+    def __init__(
+        self, cache: Optional[HttpCache] = None, throttle: Optional[Throttle] = None
+    ) -> None:
+        """
+        cache: keeps responses, see httpcache.DiskCache. A fresh one is
+            returned without a request, a stale one is revalidated with
+            If-None-Match / If-Modified-Since, and a 304 answers from it.
+        throttle: rate limits and retries requests per host, see Throttle.
+            Without it, a request is attempted once.
+        """
         self._session: Session = Session()
+        self._cache: Optional[HttpCache] = cache
+        self._throttle: Optional[Throttle] = throttle
+        self._cache_counts: Counter = Counter()
+
+    @property
+    def cache(self) -> Optional[HttpCache]:
+        return self._cache
+
+    @property
+    def throttle(self) -> Optional[Throttle]:
+        return self._throttle
+
+    def send(self, url: str, headers: Dict[str, str], tries: Dict[str, str]) -> Any:
+        tries.update(attempts="1", wait="0.000")
+        if self.throttle is None:
+            return self._session.get(url, headers=headers)
+        return self.throttle.call(
+            url, lambda: self._session.get(url, headers=headers), tries
+        )
+
+    def cache_attributes(self, event: str) -> Dict[str, str]:
+        """The cache event of a request, "hit", "miss" or "revalidated",
+        and the counts of each so far.
+        """
+        self._cache_counts[event] += 1
+        attributes = {"cache": event}
+        for name in ("hit", "miss", "revalidated"):
+            attributes[f"cache.{name:s}"] = str(self._cache_counts[name])
+        return attributes
 
     def start(self) -> None:
         explanation = f"{classname(self):s}.start()"
@@ -19,6 +60,8 @@ class Scraper:
     def stop(self) -> None:
         # https://stackoverflow.com/questions/49253246/how-to-close-requests-session
         self._session.close()
+        if self.cache is not None:
+            self.cache.close()
         explanation = f"{classname(self):s}.stop()"
         print(explanation)
         logging.info(explanation)
@@ -27,15 +70,49 @@ class Scraper:
         explanation = f"{classname(self):s}.get({url:s}) 1"
         print(explanation)
         logging.info(explanation)
+        headers = {"User-Agent": "Mozilla/5.0"}
+        tries: Dict[str, str] = {}
         try:
-            response = self._session.get(url, headers={"User-Agent": "Mozilla/5.0"})
-            content, http_code = response.text, response.status_code 
+            entry = None if self.cache is None else self.cache.lookup(url)
+            if entry is not None:
+                cached = self.cache.read(url) if is_fresh(entry) else None
+                if cached is not None:
+                    attributes = {
+                        "timestamp": get_timestamp(),
+                        "original url": url,
+                        "response.url": entry["response.url"],
+                        "http_code": entry["http_code"],
+                        # no request, but the same keys as a fetched result
+                        "attempts": "0",
+                        "wait": "0.000",
+                    }
+                    attributes.update(self.cache_attributes("hit"))
+                    logging.info(f"{classname(self):s}.get({url:s}) - cache hit")
+                    return cached, attributes
+                if entry["etag"] is not None:
+                    headers["If-None-Match"] = entry["etag"]
+                if entry["last_modified"] is not None:
+                    headers["If-Modified-Since"] = entry["last_modified"]
+            response = self.send(url, headers, tries)
+            content, http_code = response.text, response.status_code
             attributes = {
                 "timestamp": get_timestamp(),
                 "original url": url,
                 "response.url": response.url,
                 "http_code": str(http_code),
             }
+            if self.cache is not None:
+                cached = self.cache.read(url) if http_code == 304 and entry else None
+                if cached is not None:
+                    self.cache.refresh(url, response.headers)
+                    content = cached
+                    attributes["response.url"] = entry["response.url"]
+                    attributes["http_code"] = entry["http_code"]
+                    attributes.update(self.cache_attributes("revalidated"))
+                else:
+                    if http_code == 200:
+                        self.cache.store(url, content, response.headers, attributes)
+                    attributes.update(self.cache_attributes("miss"))
         except Exception as message:
             content, http_code = "", -1
             attributes = {"error": str(message), "http_code": str(http_code)}
@@ -51,15 +128,18 @@ class Scraper:
             )
             print(explanation)
             logging.info(explanation)
+        attributes.update(tries)
         explanation = f"{classname(self):s}.get({url:s}) 4"
         logging.info(explanation)
         return content, attributes
 
 
 @contextmanager
-def open_scraper() -> Generator[Scraper, None, None]:
+def open_scraper(
+    cache: Optional[HttpCache] = None, throttle: Optional[Throttle] = None
+) -> Generator[Scraper, None, None]:
     try:
-        client = Scraper()
+        client = Scraper(cache, throttle)
         client.start()
         yield client
     except Exception as error:
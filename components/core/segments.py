@@ -0,0 +1,336 @@
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import IO, Any, Callable, Dict, Generator, List, Optional, Tuple
+
+# optional, better and faster compression than gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from components.core.codecs import Codec, get_codec, stringify
+from components.core.filters import All, Between, Equals, Filter, In, Prefix
+from components.core.messages import MessageGenerator
+from components.helpers import classname, get_directory, get_resource
+
+
+class SegmentError(Exception):
+    pass
+
+
+COMPRESSIONS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+SUFFIXES = {"zstd": ".jsonl.zst", "gzip": ".jsonl.gz", "": ".jsonl"}
+
+# bounds of older segments.json are dropped: version 1 skipped null values
+VERSION = 2
+
+
+def _open_compressed(resource: Path, compression: str) -> IO[bytes]:
+    if compression == "zstd":
+        handle = open(resource, "rb")
+        return zstandard.ZstdDecompressor().stream_reader(handle, closefd=True)
+    if compression == "gzip":
+        return gzip.open(resource, "rb")
+    return open(resource, "rb")
+
+
+def _compress(origin: Path, target: Path, compression: str) -> None:
+    scratch = target.with_name(f"{target.name:s}.tmp")
+    with open(origin, "rb") as source:
+        if compression == "zstd":
+            with open(scratch, "wb") as raw:
+                compressor = zstandard.ZstdCompressor(level=9)
+                with compressor.stream_writer(raw, closefd=False) as writer:
+                    shutil.copyfileobj(source, writer)
+        else:
+            with gzip.open(scratch, "wb", compresslevel=6) as writer:
+                shutil.copyfileobj(source, writer)
+    os.replace(scratch, target)
+
+
+def _lines(handle: IO[bytes]) -> Generator[bytes, None, None]:
+    rest = b""
+    while True:
+        block = handle.read(1 << 22)
+        if not block:
+            break
+        lines = (rest + block).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if rest.strip():
+        yield rest
+
+
+def _may_match(select: Any, bounds: Dict[str, List[str]]) -> bool:
+    """False only when select can't match any message of a segment
+    with these min/max bounds per field.
+    """
+    if isinstance(select, All):
+        return all(_may_match(condition, bounds) for condition in select.conditions)
+    field = getattr(select, "field", None)
+    if field not in bounds:
+        return True
+    low, high = bounds[field]
+    if isinstance(select, Equals):
+        return low <= select.value <= high
+    if isinstance(select, In):
+        return any(low <= value <= high for value in select.values)
+    if isinstance(select, Between):
+        return select.low <= high and low <= select.high
+    if isinstance(select, Prefix):
+        return low[: len(select.prefix)] <= select.prefix <= high[: len(select.prefix)]
+    return True
+
+
+class SegmentedMessageDocument:
+    """messages in a series of segment files, with the same
+    messages(), where() and update() as MessageDocument.
+    New messages go to an open, plain jsonl segment. It is closed
+    when it reaches max_bytes or is older than max_seconds, then
+    compressed. segments.json records, for each segment, its file,
+    count, bytes and the min/max of the bounded fields, so that
+    where() skips segments that can't match a Filter.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        max_bytes: int = 1 << 28,
+        max_seconds: float = 0.0,
+        compression: Optional[str] = None,
+        bounded: Tuple[str, ...] = ("timestamp",),
+        codec: Optional[str] = None,
+    ) -> None:
+        """
+        max_bytes: close the open segment at this size
+        max_seconds: close the open segment at this age, never if 0
+        compression: "zstd" or "gzip", the best installed if None
+        bounded: fields whose min/max are kept per segment
+        codec: json backend, see codecs.get_codec
+        """
+        compression = compression or COMPRESSIONS[0]
+        if compression not in COMPRESSIONS:
+            raise SegmentError(
+                f"{classname(self):s}: compression {compression:s} is not available"
+            )
+        self._directory: Path = get_directory(directory)
+        self._home: Path = get_directory(Path(self.directory, "segments"))
+        self._manifest: Path = get_resource(self.directory, "segments", ".json")
+        self._max_bytes = max_bytes
+        self._max_seconds = max_seconds
+        self._compression = compression
+        self._bounded = bounded
+        self._codec: Codec = get_codec(codec)
+        self._segments: List[Dict[str, Any]] = []
+        if self.manifest.exists():
+            self.read_manifest()
+            self.recover()
+        else:
+            self.open_segment()
+            self.write_manifest()
+
+    @property
+    def directory(self) -> Path:
+        return self._directory
+
+    @property
+    def manifest(self) -> Path:
+        return self._manifest
+
+    @property
+    def codec(self) -> Codec:
+        return self._codec
+
+    @property
+    def segments(self) -> List[Dict[str, Any]]:
+        return self._segments
+
+    @property
+    def active(self) -> Dict[str, Any]:
+        return self._segments[-1]
+
+    def resource(self, segment: Dict[str, Any]) -> Path:
+        return Path(self._home, segment["file"])
+
+    def read_manifest(self) -> None:
+        with open(self.manifest, "r", encoding="utf-8") as source:
+            manifest = json.load(source)
+        self._segments = manifest["segments"]
+        if manifest.get("version") != VERSION:
+            # without bounds, where() scans the segment
+            for segment in self.segments:
+                segment["bounds"] = {}
+            self.write_manifest()
+
+    def write_manifest(self) -> None:
+        scratch = self.manifest.with_suffix(".tmp")
+        with open(scratch, "w", encoding="utf-8") as target:
+            json.dump({"version": VERSION, "segments": self.segments}, target)
+        os.replace(scratch, self.manifest)
+
+    def open_segment(self) -> None:
+        number = len(self.segments)
+        self._segments.append(
+            {
+                "number": number,
+                "file": f"{number:08d}{SUFFIXES['']:s}",
+                "compression": "",
+                "created": time.time(),
+                "count": 0,
+                "bytes": 0,
+                "bounds": {},
+            }
+        )
+
+    def recover(self) -> None:
+        """Finishes what a crash interrupted: plain files left by a
+        compression, and an open segment longer than recorded.
+        """
+        for segment in self.segments[:-1]:
+            plain = Path(self._home, f"{segment['number']:08d}{SUFFIXES['']:s}")
+            if segment["compression"] and plain.exists():
+                plain.unlink()
+        resource = self.resource(self.active)
+        size = resource.stat().st_size if resource.exists() else 0
+        if size != self.active["bytes"]:
+            logging.warning(f"{classname(self):s}: recounting {str(resource):s}")
+            self.active.update(count=0, bytes=0, bounds={})
+            self.active["bytes"] = self.recount(resource) if size else 0
+            self.write_manifest()
+
+    def recount(self, resource: Path) -> int:
+        """Accounts the messages of the open segment, and returns its size.
+        A torn last line, left by a crash while appending, is truncated;
+        one that only lacks its newline, but decodes, gets it appended.
+        """
+        loads = self.codec.loads
+        with open(resource, "rb+") as source:
+            end = 0
+            for line in source:
+                message = None
+                try:
+                    if line.strip():
+                        message = loads(line)
+                except Exception:
+                    pass
+                if not line.endswith(b"\n"):
+                    if not isinstance(message, dict):
+                        logging.warning(
+                            f"{classname(self):s}: torn tail of {len(line):d} bytes "
+                            f"dropped from {str(resource):s}"
+                        )
+                        source.truncate(end)
+                        break
+                    source.write(b"\n")
+                    line += b"\n"
+                if message is not None:
+                    self.account(self.active, stringify(message))
+                end += len(line)
+        return end
+
+    def account(self, segment: Dict[str, Any], message: Dict[str, Any]) -> None:
+        segment["count"] += 1
+        bounds = segment["bounds"]
+        for field in self._bounded:
+            if field not in message:
+                continue
+            # as stringify() renders it, null too
+            value = str(message[field])
+            try:
+                low, high = bounds[field]
+                if value < low:
+                    bounds[field][0] = value
+                elif value > high:
+                    bounds[field][1] = value
+            except KeyError:
+                bounds[field] = [value, value]
+
+    def full(self) -> bool:
+        active = self.active
+        if active["bytes"] >= self._max_bytes:
+            return True
+        if self._max_seconds and active["count"]:
+            return time.time() - active["created"] >= self._max_seconds
+        return False
+
+    def rotate(self) -> None:
+        """Closes and compresses the open segment, opens the next one."""
+        segment = self.active
+        plain = self.resource(segment)
+        if plain.exists():
+            name = f"{segment['number']:08d}{SUFFIXES[self._compression]:s}"
+            _compress(plain, Path(self._home, name), self._compression)
+            segment["file"], segment["compression"] = name, self._compression
+        self.open_segment()
+        self.write_manifest()
+        if plain.exists():
+            plain.unlink()
+        logging.info(f"{classname(self):s}.rotate: {str(segment):s}")
+
+    def start(self) -> None:
+        """Placeholder for operations to perform before using self.messages()."""
+        pass
+
+    def stop(self) -> None:
+        """Placeholder for operations to perform after using self.messages()."""
+        pass
+
+    def segment_messages(
+        self, segment: Dict[str, Any]
+    ) -> Generator[Dict[str, str], None, None]:
+        resource = self.resource(segment)
+        if not resource.exists():
+            return
+        loads = self.codec.loads
+        with _open_compressed(resource, segment["compression"]) as source:
+            for line in _lines(source):
+                yield stringify(loads(line))
+
+    def messages(self) -> Generator[Dict[str, str], None, None]:
+        """Yields messages from every segment, oldest first."""
+        for segment in list(self.segments):
+            yield from self.segment_messages(segment)
+
+    def where(
+        self, select: Callable[[Dict[str, str]], bool]
+    ) -> Generator[Dict[str, str], None, None]:
+        """Yields the messages accepted by select. With a Filter,
+        segments whose bounds exclude it are not read at all.
+        """
+        self.start()
+        for segment in list(self.segments):
+            if isinstance(select, Filter) and not _may_match(select, segment["bounds"]):
+                continue
+            for message in self.segment_messages(segment):
+                if select(message):
+                    yield message
+        self.stop()
+
+    def update(self, origin: MessageGenerator) -> None:
+        """Appends messages to the open segment, rotating as needed."""
+        origin.start()
+        dumps = self.codec.dumps
+        if self.full():
+            self.rotate()
+        target = open(self.resource(self.active), "ab")
+        try:
+            for message in origin.messages():
+                line = dumps(message) + b"\n"
+                target.write(line)
+                self.active["bytes"] += len(line)
+                self.account(self.active, message)
+                if self.full():
+                    target.close()
+                    self.rotate()
+                    target = open(self.resource(self.active), "ab")
+        finally:
+            target.close()
+            self.write_manifest()
+        origin.stop()
@@ -0,0 +1,42 @@
+from hashlib import blake2b
+import math
+
+
+class HyperLogLog:
+    """Distinct count estimate in 2 ** precision registers,
+    about 1.04 / sqrt(2 ** precision) relative error: 1.6% for 12.
+    Sketches of the same precision merge by register max, so
+    parts of a document can be counted apart.
+    """
+
+    def __init__(self, precision: int = 12) -> None:
+        self._precision: int = precision
+        self._registers: bytearray = bytearray(1 << precision)
+
+    @property
+    def precision(self) -> int:
+        return self._precision
+
+    def add(self, value: str) -> None:
+        digest = blake2b(value.encode("utf-8"), digest_size=8).digest()
+        x = int.from_bytes(digest, "big")
+        bits = 64 - self._precision
+        index = x >> bits
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        if other.precision != self.precision:
+            raise ValueError("HyperLogLog.merge: precisions differ")
+        self._registers = bytearray(map(max, self._registers, other._registers))
+
+    def estimate(self) -> int:
+        m = len(self._registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0**-r for r in self._registers)
+        zeros = self._registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # small range correction, linear counting
+            return round(m * math.log(m / zeros))
+        return round(raw)
@@ -1,20 +1,55 @@
 import logging
 from pathlib import Path
-from typing import Generator, Tuple, Dict, Protocol
+from typing import Generator, Tuple, Dict, Protocol, Optional, Set, Any, List, Iterable
 import json
+import time
 
 from components.core.metadata import Metadata
-from components.helpers import get_container, get_resource, classname
+from components.core.blobs import BlobStore, Body
+from components.helpers import get_container, get_resource, classname, write_text
 
 
 class Store:
     def __init__(self, container: Path, identifier: str) -> None:
         self._home = get_container(container, identifier)
+        self._blobs: Optional[BlobStore] = None
 
     @property
     def home(self) -> Path:
         return self._home
 
+    @property
+    def blobs(self) -> BlobStore:
+        if self._blobs is None:
+            self._blobs = BlobStore(Path(self.home, "blobs"))
+        return self._blobs
+
+    def put_blob(self, sample_home: Path, name: str, body: Body) -> str:
+        """Stores body once in self.blobs, and a reference
+        to it in sample_home/<name>.blob. Returns the digest.
+        """
+        digest = self.blobs.put(body)
+        write_text(Path(sample_home, f"{name:s}.blob"), digest)
+        return digest
+
+    def get_blob(self, sample_home: Any, name: str) -> Path:
+        """Path of the blob referenced by sample_home/<name>.blob"""
+        digest = (sample_home / f"{name:s}.blob").read_text().strip()
+        return self.blobs.resource(digest)
+
+    def collect_blobs(self, samples: Iterable[Any]) -> int:
+        """Mark and sweep: removes the blobs no sample refers to.
+        samples: every sample home of the store, as store.iterate()
+            of a TreeStore or FlatStore yields them; a blob referenced
+            only by a sample left out is removed.
+        """
+        mark = time.time()
+        referenced: Set[str] = set()
+        for sample_home in samples:
+            for reference in sample_home.glob("*.blob"):
+                referenced.add(reference.read_text().strip())
+        return self.blobs.sweep(referenced, mark)
+
     def start(self) -> None:
         logging.info(f"{classname(self):s}.start()")
 
@@ -26,9 +61,24 @@ HOME = Path("~").expanduser()
 
 
 class SampleTask:
-    def __init__(self, identifier: str):
+    def __init__(
+        self,
+        identifier: str,
+        version: str = "0",
+        inputs: Tuple[str, ...] = (),
+        outputs: Tuple[str, ...] = (),
+    ):
+        """
+        version: change it when the task output changes,
+            so that incremental runs process every sample again
+        inputs, outputs: names of what the task reads and writes
+            in a sample, a task runs after those producing its inputs
+        """
         self._sample_home = HOME
         self._identifier = identifier
+        self._version = version
+        self._inputs = tuple(inputs)
+        self._outputs = tuple(outputs)
 
     @property
     def sample_home(self) -> Path:
@@ -42,6 +92,18 @@ class SampleTask:
     def identifier(self) -> str:
         return self._identifier
 
+    @property
+    def version(self) -> str:
+        return self._version
+
+    @property
+    def inputs(self) -> Tuple[str, ...]:
+        return self._inputs
+
+    @property
+    def outputs(self) -> Tuple[str, ...]:
+        return self._outputs
+
     def start(self) -> None:
         print(
             f"{classname(self):s}.start {self.identifier:s} - sample_home: {str(self.sample_home):s}"
@@ -63,6 +125,10 @@ class EmptySampleTask(SampleTask):
         super().__init__("EmptySampleTask")
 
 
+class SampleTaskPipelineError(Exception):
+    pass
+
+
 class SampleTaskPipeline:
     def __init__(self) -> None:
         self._tasks: Dict[str, SampleTask] = {}
@@ -79,3 +145,48 @@ class SampleTaskPipeline:
             del self._tasks[identifier]
         except KeyError:
             pass
+
+    def requirements(self) -> Dict[str, Set[str]]:
+        """The tasks each task waits for: those producing its inputs.
+        A task declaring neither inputs nor outputs waits for
+        the task added before it, as in a plain ordered pipeline.
+        """
+        producers: Dict[str, Set[str]] = {}
+        for task in self.tasks():
+            for output in task.outputs:
+                producers.setdefault(output, set()).add(task.identifier)
+        requirements: Dict[str, Set[str]] = {}
+        previous: Optional[str] = None
+        for task in self.tasks():
+            required: Set[str] = set()
+            for name in task.inputs:
+                required |= producers.get(name, set())
+            if not task.inputs and not task.outputs and previous is not None:
+                required.add(previous)
+            required.discard(task.identifier)
+            requirements[task.identifier] = required
+            previous = task.identifier
+        return requirements
+
+    def order(self) -> List[SampleTask]:
+        """Tasks sorted so that each one comes after those it waits for,
+        otherwise in the order they were added.
+        """
+        requirements = self.requirements()
+        ordered: List[SampleTask] = []
+        placed: Set[str] = set()
+        waiting = list(self.tasks())
+        while waiting:
+            ready = [t for t in waiting if requirements[t.identifier] <= placed]
+            if not ready:
+                explanation = (
+                    f"{classname(self):s}.order: cycle between "
+                    f"{', '.join(t.identifier for t in waiting):s}"
+                )
+                logging.error(explanation)
+                raise SampleTaskPipelineError(explanation)
+            for task in ready:
+                ordered.append(task)
+                placed.add(task.identifier)
+            waiting = [t for t in waiting if t.identifier not in placed]
+        return ordered
@@ -0,0 +1,179 @@
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlsplit
+
+
+# statuses worth another attempt
+RETRY_STATUSES = frozenset((408, 425, 429, 500, 502, 503, 504))
+
+# statuses meaning the host is overloaded, or is limiting us
+SLOW_DOWN = frozenset((429, 503))
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds of a Retry-After header, given in seconds or as an HTTP date."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """attempts per request, with full jitter exponential backoff:
+    a delay drawn in [0, min(cap, base * 2 ** (attempt - 1))],
+    or the Retry-After of the response, up to cap.
+    """
+
+    def __init__(
+        self,
+        attempts: int = 4,
+        base: float = 0.5,
+        cap: float = 60.0,
+        statuses: frozenset = RETRY_STATUSES,
+    ) -> None:
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.statuses = statuses
+
+    def retryable(self, status: Optional[int]) -> bool:
+        """status None is a request that raised, as a timeout."""
+        return status is None or status in self.statuses
+
+    def delay(self, attempt: int, after: Optional[str] = None) -> float:
+        seconds = retry_after(after)
+        if seconds is not None:
+            return min(seconds, self.cap)
+        return random.uniform(0.0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+
+class HostState:
+    def __init__(self, rate: float, burst: float, limit: float) -> None:
+        self.rate = rate
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.limit = limit
+        self.active = 0
+
+
+class Throttle:
+    """Per host limits for the requests of Scraper and WebClient,
+    safe to share between threads:
+    - a token bucket of rate requests per second, up to burst at once
+    - at most limit requests in flight
+    Both adapt AIMD-like: each success adds increase to the rate and
+    about one request to the limit per limit successes, each 429/503
+    or failed request halves them.
+    """
+
+    def __init__(
+        self,
+        rate: float = 10.0,
+        burst: float = 10.0,
+        concurrency: int = 8,
+        min_rate: float = 0.1,
+        max_rate: float = 100.0,
+        increase: float = 0.5,
+        policy: Optional[RetryPolicy] = None,
+    ) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._concurrency = concurrency
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._increase = increase
+        self._policy: RetryPolicy = policy or RetryPolicy()
+        self._hosts: Dict[str, HostState] = {}
+        self._condition = threading.Condition()
+
+    @property
+    def policy(self) -> RetryPolicy:
+        return self._policy
+
+    def state(self, host: str) -> HostState:
+        try:
+            return self._hosts[host]
+        except KeyError:
+            self._hosts[host] = HostState(self._rate, self._burst, self._concurrency)
+            return self._hosts[host]
+
+    def stats(self, host: str) -> Dict[str, float]:
+        with self._condition:
+            state = self.state(host)
+            return {"rate": state.rate, "limit": state.limit, "active": state.active}
+
+    def acquire(self, host: str) -> float:
+        """Waits for a slot and a token of host, returns the seconds waited."""
+        start_time = time.monotonic()
+        with self._condition:
+            state = self.state(host)
+            while state.active >= max(int(state.limit), 1):
+                self._condition.wait()
+            state.active += 1
+            now = time.monotonic()
+            state.tokens = min(self._burst, state.tokens + (now - state.updated) * state.rate)
+            state.updated = now
+            # a token is taken even if missing: waiters queue up behind it
+            state.tokens -= 1.0
+            wait = -state.tokens / state.rate if state.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return time.monotonic() - start_time
+
+    def release(self, host: str, status: Optional[int]) -> None:
+        """Frees the slot of a request, and adapts to its status,
+        None if it raised.
+        """
+        with self._condition:
+            state = self.state(host)
+            state.active -= 1
+            if status is None or status in SLOW_DOWN:
+                state.rate = max(self._min_rate, state.rate / 2)
+                state.limit = max(1.0, state.limit / 2)
+                logging.info(f"Throttle: {host:s} slowed to {state.rate:.2f}/s")
+            elif status < 500:
+                state.rate = min(self._max_rate, state.rate + self._increase)
+                state.limit = min(float(self._concurrency), state.limit + 1 / state.limit)
+            self._condition.notify_all()
+
+    def call(self, url: str, request: Callable[[], Any], tries: Dict[str, str]) -> Any:
+        """The response of request() to url, retried as the policy says.
+        The response of the last attempt is returned whatever its status;
+        the exception of the last attempt is raised. tries gets "attempts"
+        and "wait", the seconds spent waiting for the throttle and backoff.
+        """
+        host = urlsplit(url).netloc
+        waited = 0.0
+        attempt = 0
+        while True:
+            attempt += 1
+            waited += self.acquire(host)
+            tries.update(attempts=str(attempt), wait=f"{waited:.3f}")
+            try:
+                response = request()
+            except Exception as exception:
+                self.release(host, None)
+                if attempt >= self.policy.attempts:
+                    raise
+                after = None
+                logging.info(f"Throttle: {url:s} attempt {attempt:d} - {str(exception):s}")
+            else:
+                status = response.status_code
+                self.release(host, status)
+                if attempt >= self.policy.attempts or not self.policy.retryable(status):
+                    return response
+                after = response.headers.get("Retry-After")
+                logging.info(f"Throttle: {url:s} attempt {attempt:d} - status {status:d}")
+            delay = self.policy.delay(attempt, after)
+            time.sleep(delay)
+            waited += delay
+            tries["wait"] = f"{waited:.3f}"
@@ -1,12 +1,33 @@
+from contextlib import contextmanager
+import fcntl
 import json
+import os
 from pathlib import Path
 from shutil import rmtree
 import logging
-from typing import Tuple, Dict, Generator
+import multiprocessing
+import time
+from typing import Tuple, Dict, Generator, Callable, Optional, Iterator, List, Any, Union
 
 from components.core.store import Store
+from components.core.pack import (
+    PackError,
+    PackReader,
+    PackedSample,
+    check_pack,
+    get_pack,
+    get_pack_index,
+    write_pack,
+)
 from components.core.application import register_error
-from components.helpers import get_container, get_resource, classname
+from components.helpers import (
+    get_container,
+    get_resource,
+    classname,
+    get_timestamp,
+    read_json,
+    write_json,
+)
 
 
 class TreeStoreError(Exception):
@@ -15,34 +36,82 @@ class TreeStoreError(Exception):
         super().__init__(explanation)
 
 
-def base_256(number: int) -> Tuple[int, int, int]:
-    assert 0 <= number < 16777216
-    third_digit = number % 256
-    number >>= 8
-    second_digit = number % 256
-    first_digit = number >> 8
-    return first_digit, second_digit, third_digit
+DEPTH = 3
 
+# seconds after which compact packs a leaf whose samples weren't all finalized
+IDLE = 3600.0
 
-def base_10(first_digit: int, second_digit: int, third_digit: int) -> int:
-    return (((first_digit << 8) + second_digit) << 8) + third_digit
+
+def base_256(number: int, depth: int = DEPTH) -> Tuple[int, ...]:
+    """Digits of number in base 256, most significant first,
+    left padded with zeros to at least depth digits.
+    """
+    assert 0 <= number
+    digits = []
+    while number or len(digits) < depth:
+        digits.append(number % 256)
+        number >>= 8
+    return tuple(reversed(digits))
+
+
+def base_10(*digits: int) -> int:
+    number = 0
+    for digit in digits:
+        number = (number << 8) + digit
+    return number
+
+
+def sample_number(samples: Path, sample_home: Path) -> int:
+    parts = sample_home.relative_to(samples).parts
+    if parts[0].startswith("d"):
+        parts = parts[1:]
+    return base_10(*(int(p) for p in parts))
 
 
 def erase_directory(base: Path) -> None:
     rmtree(base, ignore_errors=True)
 
 
-def _get_sample_home(samples: Path, number: int) -> Path:
-    first_digit, second_digit, third_digit = base_256(number)
-    sample_home = Path(
-        samples, f"{first_digit:>03d}", f"{second_digit:>03d}", f"{third_digit:>03d}"
-    )
-    return sample_home
+def last_modified(base: Path) -> float:
+    """The newest mtime of base and of everything below it."""
+    newest = base.stat().st_mtime
+    for root, directories, files in os.walk(base):
+        for name in directories + files:
+            newest = max(newest, os.lstat(os.path.join(root, name)).st_mtime)
+    return newest
+
+
+def _get_sample_home(samples: Path, number: int, depth: int = DEPTH) -> Path:
+    """Numbers with up to depth digits live in samples/AAA/BBB/...,
+    larger numbers in samples/dN/AAA/BBB/..., where N is their count
+    of digits. Names like d4 never clash with 000-255, so a store
+    grows past 256 ** depth samples without moving existing ones.
+    """
+    digits = base_256(number, depth)
+    names = [f"{digit:>03d}" for digit in digits]
+    if len(digits) > depth:
+        names.insert(0, f"d{len(digits):d}")
+    return Path(samples, *names)
 
 
 class Index:
-    def __init__(self, resource: Path) -> None:
+    def __init__(
+        self,
+        resource: Path,
+        lease: int = 1,
+        used: Optional[Callable[[int], bool]] = None,
+    ) -> None:
+        """
+        resource: the index.json file
+        lease: how many values are reserved on each write of the resource
+        used: tells if a value was handed out, to reclaim a lease after a crash
+        """
+        if lease < 1:
+            raise TreeStoreError(f"Index: bad lease {lease:d}")
         self._resource: Path = resource
+        self._journal: Path = resource.with_suffix(".lease")
+        self._lease: int = lease
+        self._used: Optional[Callable[[int], bool]] = used
         if self.resource.exists():
             # restarting Index
             value = self.read()
@@ -51,11 +120,22 @@ class Index:
             # initialize Index
             self._value = 0
             self.write()
+        self._limit: int = self._value
+        if self.journal.exists():
+            self.recover()
 
     @property
     def resource(self) -> Path:
         return self._resource
 
+    @property
+    def journal(self) -> Path:
+        return self._journal
+
+    @property
+    def lease(self) -> int:
+        return self._lease
+
     @property
     def value(self) -> int:
         return self._value
@@ -63,7 +143,18 @@ class Index:
     @value.setter
     def value(self, update: int) -> None:
         self._value = update
-        self.write()
+        if self.lease == 1:
+            self.write()
+
+    def top(self) -> int:
+        """Returns the number of values handed out so far."""
+        return self.value
+
+    def acquire(self) -> int:
+        """Returns the current value, covered by a lease when leasing."""
+        if self.lease > 1 and self.value >= self._limit:
+            self.reserve()
+        return self.value
 
     def write(self) -> None:
         value = {"index": str(self.value)}
@@ -75,17 +166,216 @@ class Index:
             values = json.load(source)
         return values
 
+    def reserve(self) -> None:
+        """Reserve the block [value, value + lease) in the journal.
+        The journal is replaced atomically, so a crash leaves either
+        the previous block or the new one.
+        """
+        self._limit = self.value + self.lease
+        block = {"start": str(self.value), "stop": str(self._limit)}
+        scratch = self.journal.with_suffix(".tmp")
+        with open(scratch, "w") as target:
+            json.dump(block, target)
+        os.replace(scratch, self.journal)
+
+    def recover(self) -> None:
+        """A journal left behind means the last lease was not released.
+        Values of the block that were never used are reclaimed when
+        self._used is available, otherwise the whole block is skipped.
+        """
+        with open(self.journal, "r") as source:
+            block = json.load(source)
+        start, stop = int(block["start"]), int(block["stop"])
+        if self._used is None:
+            value = stop
+        else:
+            # values are handed out in order, so the used ones are a prefix
+            low, high = start, stop
+            while low < high:
+                middle = (low + high) // 2
+                if self._used(middle):
+                    low = middle + 1
+                else:
+                    high = middle
+            value = low
+        logging.warning(
+            f"Index.recover: lease [{start:d}, {stop:d}) resumed at {value:d}"
+        )
+        self._value = max(self._value, value)
+        self.release()
+
+    def release(self) -> None:
+        """Write the exact value and drop the lease journal."""
+        self.write()
+        self._limit = self.value
+        if self.journal.exists():
+            self.journal.unlink()
+
+
+class SharedIndex(Index):
+    """An Index that several processes on one host can use at once.
+    Every reservation takes an exclusive fcntl lock on index.lock,
+    reads index.json and moves it forward by lease, so each process
+    hands out values from its own block. A crashed process, or one
+    whose block is not the last one, leaves a gap of unused values.
+    """
+
+    def __init__(self, resource: Path, lease: int = 1) -> None:
+        if lease < 1:
+            raise TreeStoreError(f"SharedIndex: bad lease {lease:d}")
+        self._resource: Path = resource
+        self._journal: Path = resource.with_suffix(".lease")
+        self._lock: Path = resource.with_suffix(".lock")
+        self._lease: int = lease
+        self._used: Optional[Callable[[int], bool]] = None
+        with self.locked():
+            if self.resource.exists():
+                self._value = int(self.read()["index"])
+            else:
+                self._value = 0
+                self.write()
+        self._limit: int = self._value
+
+    @property
+    def lock(self) -> Path:
+        return self._lock
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        with open(self.lock, "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    @Index.value.setter
+    def value(self, update: int) -> None:
+        self._value = update
+
+    def acquire(self) -> int:
+        if self.value >= self._limit:
+            self.reserve()
+        return self.value
+
+    def top(self) -> int:
+        with self.locked():
+            return int(self.read()["index"])
+
+    def reserve(self) -> None:
+        with self.locked():
+            self._value = int(self.read()["index"])
+            self._limit = self.value + self.lease
+            self.write_limit()
+
+    def release(self) -> None:
+        """Give back the unused part of the block, if it is the last one."""
+        with self.locked():
+            if int(self.read()["index"]) == self._limit:
+                self.write()
+        self._limit = self.value
+
+    def write_limit(self) -> None:
+        value = {"index": str(self._limit)}
+        with open(self.resource, "w") as target:
+            json.dump(value, target)
+
+
+class Manifest:
+    """Append-only log of sample events, one json record per line:
+    index, timestamp, status, size and files of the sample.
+    The last record of an index holds its current status.
+    """
+
+    def __init__(self, resource: Path) -> None:
+        self._resource: Path = resource
+        self._target = None
+
+    @property
+    def resource(self) -> Path:
+        return self._resource
+
+    def append(
+        self, index: int, status: str, size: int = 0, files: Optional[List[str]] = None
+    ) -> None:
+        record = {
+            "index": index,
+            "timestamp": get_timestamp(),
+            "status": status,
+            "size": size,
+            "files": files or [],
+        }
+        if self._target is None:
+            # line buffered: every record is a single append
+            self._target = open(self.resource, "a", encoding="utf-8", buffering=1)
+        self._target.write(f"{json.dumps(record):s}\n")
+
+    def close(self) -> None:
+        if self._target is not None:
+            self._target.close()
+            self._target = None
+
+    def records(self) -> Generator[Dict[str, Any], None, None]:
+        if not self.resource.exists():
+            return
+        with open(self.resource, "r", encoding="utf-8") as source:
+            for line in source:
+                yield json.loads(line)
+
+    def samples(self) -> Dict[int, Dict[str, Any]]:
+        """Folds the log: creation timestamp from the first record
+        of each index, status, size and files from the last one.
+        """
+        table: Dict[int, Dict[str, Any]] = {}
+        for record in self.records():
+            index = record["index"]
+            if index in table:
+                record["timestamp"] = table[index]["timestamp"]
+            table[index] = record
+        return table
+
+    def select(
+        self, status: Optional[str] = None, since: Optional[str] = None
+    ) -> Generator[Dict[str, Any], None, None]:
+        table = self.samples()
+        for index in sorted(table.keys()):
+            record = table[index]
+            if status is not None and record["status"] != status:
+                continue
+            if since is not None and record["timestamp"] < since:
+                continue
+            yield record
+
 
 class TreeStore(Store):
-    def __init__(self, container: Path, identifier: str) -> None:
+    def __init__(
+        self,
+        container: Path,
+        identifier: str,
+        lease: int = 1,
+        shared: bool = False,
+        depth: Optional[int] = None,
+    ) -> None:
         """
         home: path where TreeStore lives
         identifier: the name of the TreeStore
+        lease: how many sample indices are reserved at once (see Index)
+        shared: several processes create samples in this TreeStore
+        depth: levels of the sample tree, fixed when the store is created
+            (see _get_sample_home), 3 for stores without layout.json
         """
         super().__init__(container, identifier)
         self._samples = get_container(self.home, "samples")
         resource = get_resource(self.home, "index", ".json")
-        self._index = Index(resource)
+        self._depth = self.read_depth(resource, depth)
+        self._shared = shared
+        self._manifest = Manifest(get_resource(self.home, "manifest", ".jsonl"))
+        self._packs: Dict[Path, Optional[PackReader]] = {}
+        self._index: Index = (
+            SharedIndex(resource, lease)
+            if shared
+            else Index(resource, lease, self.sample_exists)
+        )
 
     @property
     def samples(self) -> Path:
@@ -95,35 +385,254 @@ class TreeStore(Store):
     def index(self) -> int:
         return self._index.value
 
+    @property
+    def shared(self) -> bool:
+        return self._shared
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def read_depth(self, resource: Path, depth: Optional[int]) -> int:
+        layout = get_resource(self.home, "layout", ".json")
+        if layout.exists():
+            stored = int(read_json(layout)["depth"])
+        elif resource.exists():
+            # a store older than layout.json
+            stored = DEPTH
+        else:
+            stored = DEPTH if depth is None else depth
+            if stored < 1:
+                explanation = f"{classname(self):s}: bad depth {stored:d}"
+                register_error(explanation)
+                raise TreeStoreError(explanation)
+            write_json(layout, {"depth": str(stored)})
+        if depth is not None and depth != stored:
+            explanation = (
+                f"{classname(self):s}: depth {depth:d} "
+                f"doesn't match the stored depth {stored:d}"
+            )
+            register_error(explanation)
+            raise TreeStoreError(explanation)
+        return stored
+
+    @property
+    def manifest(self) -> Manifest:
+        return self._manifest
+
     def update_index(self) -> None:
         self._index.value += 1
 
     def create_sample_home(self) -> Path:
-        sample_home = _get_sample_home(self.samples, self.index)
+        k = self._index.acquire()
+        sample_home = _get_sample_home(self.samples, k, self.depth)
         sample_home.mkdir(mode=0o700, parents=True, exist_ok=False)
         self.update_index()
+        self.manifest.append(k, "created")
         return sample_home
 
+    def finalize_sample_home(self, sample_home: Path, status: str = "complete") -> None:
+        """Records status, size and files of a sample in the manifest."""
+        files: List[str] = []
+        size = 0
+        with os.scandir(sample_home) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    files.append(entry.name)
+                    size += entry.stat().st_size
+        self.manifest.append(
+            sample_number(self.samples, sample_home), status, size, sorted(files)
+        )
+
     def start(self):
         logging.info(f"treestore.start() with index {self.index:d}")
 
     def stop(self):
+        self._index.release()
+        self.manifest.close()
+        self.close_packs()
         logging.info(f"treestore.stop() with index {self.index:d}")
 
-    def iterate(self, top: int = -1) -> Generator[Path, None, None]:
+    def iterate(
+        self,
+        top: int = -1,
+        status: Optional[str] = None,
+        since: Optional[str] = None,
+    ) -> Generator[Union[Path, PackedSample], None, None]:
+        """
+        Yields a Path for each sample, or a PackedSample if it was compacted.
+        top: iterate over the first top samples, all of them if -1
+        status, since: read the manifest instead, and yield only
+            samples with that status, created at or after since
+            (a get_timestamp() string)
+        """
+        if status is not None or since is not None:
+            for record in self.manifest.select(status, since):
+                if top == -1 or record["index"] < top:
+                    yield self.get_sample(record["index"])
+            return
+        limit = self._index.top()
         if top == -1:
-            top = self.index
-        elif 0 <= top <= self.index:
+            top = limit
+        elif 0 <= top <= limit:
             pass
         else:
             explanation = (
                 f"{classname(self):s}.samples:"
-                f"top {top:d} out of range (-1, {self.index:d})"
+                f"top {top:d} out of range (-1, {limit:d})"
             )
             register_error(explanation)
             raise TreeStoreError(explanation)
         for k in range(top):
-            yield _get_sample_home(self.samples, k)
+            sample_home = self.get_sample(k)
+            if self.shared and not sample_home.exists():
+                # a gap left by another writer
+                continue
+            yield sample_home
 
     def get_sample_home(self, k: int) -> Path:
-        return _get_sample_home(self.samples, k)
+        return _get_sample_home(self.samples, k, self.depth)
+
+    def get_sample(self, k: int) -> Union[Path, PackedSample]:
+        sample_home = _get_sample_home(self.samples, k, self.depth)
+        reader = self.pack_reader(sample_home.parent)
+        if reader is not None and sample_home.name in reader.offsets:
+            return reader.sample(sample_home.name)
+        return sample_home
+
+    def sample_exists(self, k: int) -> bool:
+        return self.get_sample(k).exists()
+
+    def pack_reader(self, leaf: Path) -> Optional[PackReader]:
+        try:
+            return self._packs[leaf]
+        except KeyError:
+            reader = PackReader(leaf) if get_pack_index(leaf).exists() else None
+            self._packs[leaf] = reader
+            return reader
+
+    def close_packs(self) -> None:
+        for reader in self._packs.values():
+            if reader is not None:
+                reader.close()
+        self._packs.clear()
+
+    def compact(self, top: int = -1, idle: float = IDLE) -> int:
+        """Packs every leaf directory (256 consecutive samples)
+        below top, and returns how many leaves were packed.
+        The last, partially filled leaf is never packed by default.
+        A leaf is packed once all its samples are finalized in the
+        manifest, or nothing in it changed for idle seconds. Shared,
+        compaction stops at the first leaf that isn't: other processes
+        may still hand out the samples of their leases.
+        """
+        limit = self._index.top()
+        if top == -1:
+            top = limit
+        elif not 0 <= top <= limit:
+            explanation = (
+                f"{classname(self):s}.compact:"
+                f"top {top:d} out of range (-1, {limit:d})"
+            )
+            register_error(explanation)
+            raise TreeStoreError(explanation)
+        table = self.manifest.samples()
+        cutoff = time.time() - idle
+        packed = 0
+        for start in range(0, top - top % 256, 256):
+            leaf = _get_sample_home(self.samples, start, self.depth).parent
+            if leaf == self.samples or not leaf.is_dir():
+                # samples itself is the leaf of depth 1, or already packed
+                continue
+            if get_pack_index(leaf).exists():
+                # packing again would drop the samples already packed
+                logging.warning(
+                    f"{classname(self):s}.compact: {str(leaf):s} "
+                    f"has samples added after it was packed"
+                )
+                continue
+            finished = all(
+                table.get(k, {}).get("status", "created") != "created"
+                for k in range(start, start + 256)
+            )
+            if not finished and last_modified(leaf) > cutoff:
+                if self.shared:
+                    break
+                continue
+            try:
+                write_pack(leaf)
+                # erase only what the pack is known to hold
+                check_pack(leaf)
+            except PackError as error:
+                for packed_file in (get_pack(leaf), get_pack_index(leaf)):
+                    packed_file.unlink(missing_ok=True)
+                logging.warning(f"{classname(self):s}.compact: {str(error):s}, not packed")
+                continue
+            erase_directory(leaf)
+            reader = self._packs.pop(leaf, None)
+            if reader is not None:
+                reader.close()
+            packed += 1
+        logging.info(f"{classname(self):s}.compact: {packed:d} leaves packed")
+        return packed
+
+
+def benchmark(
+    container: Path, samples: int = 20000, leases: Tuple[int, ...] = (1, 1024)
+) -> Dict[int, float]:
+    """Samples per second created by create_sample_home with each lease,
+    in a new TreeStore under container per lease. Lease 1 writes
+    index.json for every sample, as before leasing.
+    """
+    rates: Dict[int, float] = {}
+    for lease in leases:
+        store = TreeStore(container, f"benchmark-{lease:d}-{time.time_ns():d}", lease)
+        start_time = time.perf_counter()
+        for _ in range(samples):
+            store.create_sample_home()
+        store.stop()
+        rates[lease] = samples / max(time.perf_counter() - start_time, 1e-9)
+        logging.info(f"treestore.benchmark: lease {lease:d}, {rates[lease]:.0f} samples/s")
+    return rates
+
+
+def _allocate(container: Path, identifier: str, samples: int, lease: int) -> List[str]:
+    store = TreeStore(container, identifier, lease, shared=True)
+    try:
+        return [str(store.create_sample_home()) for _ in range(samples)]
+    finally:
+        store.stop()
+
+
+def stress(
+    container: Path, processes: int = 16, samples: int = 100000, lease: int = 256
+) -> int:
+    """Creates samples sample homes in one shared TreeStore under
+    container, from processes processes at once. Raises TreeStoreError
+    if two of them got the same sample home, or if the store doesn't
+    hold them all. Returns how many samples were created.
+    """
+    identifier = f"stress-{time.time_ns():d}"
+    # created once, not by every process at the same time
+    store = TreeStore(container, identifier, lease, shared=True)
+    counts = [samples // processes + (k < samples % processes) for k in range(processes)]
+    start_time = time.perf_counter()
+    with multiprocessing.get_context().Pool(processes) as pool:
+        allocated = pool.starmap(
+            _allocate, [(container, identifier, count, lease) for count in counts]
+        )
+    seconds = time.perf_counter() - start_time
+    homes = [home for homes in allocated for home in homes]
+    found = sum(1 for _ in store.iterate())
+    if len(set(homes)) != samples or found != samples:
+        explanation = (
+            f"treestore.stress: {samples:d} samples expected, "
+            f"{len(set(homes)):d} distinct homes allocated, {found:d} in the store"
+        )
+        register_error(explanation)
+        raise TreeStoreError(explanation)
+    logging.info(
+        f"treestore.stress: {processes:d} processes, {samples:d} samples "
+        f"in {seconds:.2f}s, no collision"
+    )
+    return samples
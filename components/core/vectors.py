@@ -0,0 +1,290 @@
+from collections import Counter
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+from typing import IO, Any, Dict, Generator, Iterable, List, Optional, Tuple
+
+# optional, needed only for column chunks
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class VectorError(Exception):
+    pass
+
+
+CHUNK_BYTES = 1 << 24
+
+# values of the first chunk that decide the type of a column
+INFER = 1 << 12
+
+# how write() renders a missing value
+NULLS = ("None", "")
+
+# a column that fails its type is read as the next one
+WIDER = {"bool": "str", "int": "float", "float": "str", "str": "str"}
+
+
+def _check() -> None:
+    if numpy is None:
+        raise VectorError("vectors: numpy is not installed")
+
+
+def read_header(resource: Path) -> List[str]:
+    with open(resource, "r", encoding="utf-8") as source:
+        header = source.readline().rstrip("\n")
+    return header.split("|") if header else []
+
+
+def _split(text: str, width: int) -> Tuple[List[str], int]:
+    """The fields of the rows in text, row after row, split in one pass,
+    and the number of rows.
+    """
+    if text.endswith("\n"):
+        text = text[:-1]
+    rows = text.count("\n") + 1
+    fields = text.replace("\n", "|").split("|")
+    if len(fields) != rows * width:
+        raise VectorError(
+            f"vectors: rows of {width:d} fields expected, "
+            "a value holds | or a line is torn"
+        )
+    return fields, rows
+
+
+def _blocks(source: IO[str], chunk_bytes: int) -> Generator[str, None, None]:
+    """Whole lines from source, about chunk_bytes at a time."""
+    rest = ""
+    while True:
+        block = source.read(chunk_bytes)
+        if not block:
+            break
+        block = rest + block
+        cut = block.rfind("\n") + 1
+        if cut:
+            rest = block[cut:]
+            yield block[:cut]
+        else:
+            rest = block
+    if rest:
+        yield rest
+
+
+def _infer(values: List[str]) -> str:
+    present = [value for value in values[:INFER] if value not in NULLS]
+    if not present:
+        return "str"
+    if all(value in ("True", "False") for value in present):
+        return "bool"
+    for name, dtype in (("int", numpy.int64), ("float", numpy.float64)):
+        try:
+            numpy.array(present, dtype=dtype)
+            return name
+        except (ValueError, OverflowError):
+            continue
+    return "str"
+
+
+def _convert(values: List[str], name: str) -> Any:
+    """values as an array of type name; raises ValueError if they don't fit.
+    Strings are kept as objects: a fixed width array would take the
+    width of the longest value for every one.
+    """
+    if name == "str":
+        return numpy.array(values, dtype=object)
+    if name == "bool":
+        column = numpy.array(values, dtype=object)
+        truth = column == "True"
+        if not (truth | (column == "False")).all():
+            raise ValueError("not a bool")
+        return truth
+    if name == "int":
+        return numpy.array(values, dtype=numpy.int64)
+    try:
+        return numpy.array(values, dtype=numpy.float64)
+    except ValueError:
+        # nulls are NaN
+        values = ["nan" if value in NULLS else value for value in values]
+        return numpy.array(values, dtype=numpy.float64)
+
+
+class ColumnCache:
+    """Column chunks of a rows.csv saved as .npy files in a sibling
+    directory, rows_columns/<chunk>/<position>.npy, and read back
+    memory-mapped while rows.csv keeps its size and mtime. String
+    columns, which can't be memory-mapped, are saved as <position>.txt,
+    a value per line. columns.json records the chunks, and the columns
+    complete in them.
+    """
+
+    def __init__(self, resource: Path, chunk_bytes: int) -> None:
+        self._resource: Path = resource
+        self._home: Path = Path(resource.parent, f"{resource.stem:s}_columns")
+        self._state_resource: Path = Path(self._home, "columns.json")
+        self._chunk_bytes: int = chunk_bytes
+        self._state: Dict[str, Any] = self.read_state()
+
+    @property
+    def home(self) -> Path:
+        return self._home
+
+    def current(self) -> Dict[str, Any]:
+        stat = self._resource.stat()
+        return {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "chunk_bytes": self._chunk_bytes,
+        }
+
+    def read_state(self) -> Dict[str, Any]:
+        if self._state_resource.exists():
+            with open(self._state_resource, "r", encoding="utf-8") as source:
+                state = json.load(source)
+            if all(state.get(key) == value for key, value in self.current().items()):
+                return state
+        if self.home.exists():
+            # rows.csv was written again
+            shutil.rmtree(self.home)
+        return dict(self.current(), chunks=0, columns={})
+
+    def write_state(self) -> None:
+        self.home.mkdir(parents=True, exist_ok=True)
+        scratch = self._state_resource.with_suffix(".tmp")
+        with open(scratch, "w", encoding="utf-8") as target:
+            json.dump(self._state, target)
+        os.replace(scratch, self._state_resource)
+
+    def holds(self, positions: Dict[str, int], types: Dict[str, str]) -> bool:
+        cached = self._state["columns"]
+        return all(column in cached for column in positions) and all(
+            cached[column] == types[column] for column in types if column in positions
+        )
+
+    def read(self, positions: Dict[str, int]) -> Generator[Dict[str, Any], None, None]:
+        for number in range(self._state["chunks"]):
+            directory = Path(self.home, f"{number:d}")
+            yield {
+                column: self.load(directory, position)
+                for column, position in positions.items()
+            }
+
+    def load(self, directory: Path, position: int) -> Any:
+        text = Path(directory, f"{position:d}.txt")
+        if text.exists():
+            lines = text.read_text(encoding="utf-8").split("\n")
+            return numpy.array(lines[:-1], dtype=object)
+        return numpy.load(Path(directory, f"{position:d}.npy"), mmap_mode="r")
+
+    def save(self, number: int, positions: Dict[str, int], chunk: Dict[str, Any]) -> None:
+        directory = Path(self.home, f"{number:d}")
+        directory.mkdir(parents=True, exist_ok=True)
+        for column, position in positions.items():
+            values = chunk[column]
+            text = Path(directory, f"{position:d}.txt")
+            array = Path(directory, f"{position:d}.npy")
+            if values.dtype == object:
+                # values of rows.csv hold no newline
+                text.write_text("".join(f"{value:s}\n" for value in values), encoding="utf-8")
+                array.unlink(missing_ok=True)
+            else:
+                numpy.save(array, values)
+                text.unlink(missing_ok=True)
+
+    def complete(self, chunks: int, types: Dict[str, str]) -> None:
+        """Records the columns of types as cached in chunks chunks."""
+        if self._state["chunks"] != chunks:
+            self._state["columns"] = {}
+        self._state["chunks"] = chunks
+        self._state["columns"].update(types)
+        self.write_state()
+
+
+def read_chunks(
+    resource: Path,
+    columns: Optional[List[str]] = None,
+    chunk_bytes: int = CHUNK_BYTES,
+    types: Optional[Dict[str, str]] = None,
+    cache: bool = False,
+) -> Generator[Dict[str, Any], None, None]:
+    """Yields {column: array} for about chunk_bytes of a rows.csv at a time.
+    columns: the columns to load, all if None
+    types: "int", "float", "bool" or "str" per column, the others are
+        inferred from the first chunk. A column that doesn't fit its type
+        in a later chunk is widened (int to float, to str) from there on.
+    cache: read the columns from, or save them to, a ColumnCache
+    """
+    _check()
+    header = read_header(resource)
+    width = len(header)
+    columns = header if columns is None else columns
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise VectorError(f"vectors: no columns {missing!r} in {str(resource):s}")
+    positions = {column: header.index(column) for column in columns}
+    types = dict(types or {})
+    column_cache = ColumnCache(resource, chunk_bytes) if cache else None
+    if column_cache is not None and column_cache.holds(positions, types):
+        yield from column_cache.read(positions)
+        return
+    number = 0
+    with open(resource, "r", encoding="utf-8") as source:
+        source.readline()
+        for text in _blocks(source, chunk_bytes) if width else ():
+            fields, _ = _split(text, width)
+            chunk = {}
+            for column, position in positions.items():
+                values = fields[position::width]
+                if column not in types:
+                    types[column] = _infer(values)
+                while True:
+                    try:
+                        chunk[column] = _convert(values, types[column])
+                        break
+                    except (ValueError, OverflowError):
+                        wider = WIDER[types[column]]
+                        logging.warning(
+                            f"vectors: column {column:s} widened "
+                            f"from {types[column]:s} to {wider:s}"
+                        )
+                        types[column] = wider
+            if column_cache is not None:
+                column_cache.save(number, positions, chunk)
+            number += 1
+            yield chunk
+    if column_cache is not None:
+        column_cache.complete(number, {column: types[column] for column in positions})
+
+
+def merge_counts(total: Counter, column: Any) -> None:
+    values, counts = numpy.unique(column, return_counts=True)
+    total.update(dict(zip(values.tolist(), counts.tolist())))
+
+
+def column_range(chunks: Iterable[Dict[str, Any]], column: str) -> Tuple[float, float]:
+    """min and max of column over chunks, NaN ignored, (0, 1) if empty."""
+    low, high = numpy.inf, -numpy.inf
+    for chunk in chunks:
+        values = chunk[column]
+        if len(values):
+            low = min(low, numpy.nanmin(values))
+            high = max(high, numpy.nanmax(values))
+    if low > high:
+        return 0.0, 1.0
+    return float(low), float(high)
+
+
+def histogram_edges(bins: int, low: float, high: float) -> Any:
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    return numpy.linspace(low, high, bins + 1)
+
+
+def add_histogram(counts: Optional[Any], column: Any, edges: Any) -> Any:
+    if column.dtype.kind == "f":
+        column = column[~numpy.isnan(column)]
+    found, _ = numpy.histogram(column, bins=edges)
+    return found if counts is None else counts + found
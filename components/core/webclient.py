@@ -1,15 +1,22 @@
 import logging
 from contextlib import contextmanager
-from typing import Any, Dict, Generator
+from typing import Any, Dict, Generator, Optional
 
 from requests import Session
 
 from components.helpers import classname
+from components.core.throttle import Throttle
 
 
 class WebClient:
-    def __init__(self) -> None:
+    def __init__(self, throttle: Optional[Throttle] = None) -> None:
+        """throttle: rate limits and retries requests per host, see Throttle."""
         self._session: Session = Session()
+        self._throttle: Optional[Throttle] = throttle
+
+    @property
+    def throttle(self) -> Optional[Throttle]:
+        return self._throttle
 
     def start(self) -> None:
         logging.info(f"{classname(self):s}.start()")
@@ -21,18 +28,26 @@ class WebClient:
 
     def get(self, url: str) -> Dict[Any, Any]:
         logging.info(f"{classname(self):s}.get({url:s}) 1")
+        tries = {"attempts": "1", "wait": "0.000"}
+        headers = {"User-Agent": "Mozilla/5.0"}
         try:
-            response = self._session.get(url, headers={"User-Agent": "Mozilla/5.0"})
+            if self.throttle is None:
+                response = self._session.get(url, headers=headers)
+            else:
+                response = self.throttle.call(
+                    url, lambda: self._session.get(url, headers=headers), tries
+                )
         except Exception as exception:
             explanation = (
                 f"{classname(self):s}.get({url:s}) 2 - " f"error {str(exception):s}"
             )
             logging.debug(explanation)
-            return {"errorMessage": explanation}
+            return {"errorMessage": explanation, **tries}
         else:
             explanation = (
                 f"{classname(self):s}.get({url:s} 3 - "
-                f"status_code: {response.status_code:d}"
+                f"status_code: {response.status_code:d}, "
+                f"attempts: {tries['attempts']:s}, wait: {tries['wait']:s}"
             )
             logging.info(explanation)
             if response.status_code == 200:
@@ -43,14 +58,14 @@ class WebClient:
                     f"error unexpected status_code: {response.status_code:d}"
                 )
                 logging.debug(explanation)
-                return {"errorMessage": explanation}
+                return {"errorMessage": explanation, **tries}
         logging.info(f"{classname(self):s}.get({url:s}) 4")
 
 
 @contextmanager
-def open_webclient() -> Generator[WebClient, None, None]:
+def open_webclient(throttle: Optional[Throttle] = None) -> Generator[WebClient, None, None]:
     try:
-        webclient = WebClient()
+        webclient = WebClient(throttle)
         webclient.start()
         yield webclient
     except Exception as error: